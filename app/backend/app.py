@@ -4,8 +4,9 @@ import logging
 import mimetypes
 import os
 import time
+import weakref
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Callable
 
 import aiohttp
 import openai
@@ -28,7 +29,13 @@ from quart_cors import cors
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 # from approaches.retrievethenread import RetrieveThenReadApproach
+from core.admission import AdmissionController, AdmissionRejectedError
 from core.authentication import AuthenticationHelper
+from core.metrics import metrics
+from core.pagination import InvalidContinuationError
+from core.sharedcache import create_shared_cache
+from core.sqlexecutor import QueryQueueFullError
+from core.sqlguard import QueryRejectedError
 
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
@@ -36,6 +43,7 @@ CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
 CONFIG_AUTH_CLIENT = "auth_client"
+CONFIG_ADMISSION = "admission_controller"
 
 bp = Blueprint("routes", __name__, static_folder="static")
 
@@ -67,9 +75,16 @@ async def favicon():
 async def assets(path):
     return await send_from_directory(Path(__file__).resolve().parent / "static" / "assets", path)
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
-    async for event in r:
-        yield json.dumps(event, ensure_ascii=False) + "\n"
+async def format_as_ndjson(r: AsyncGenerator[dict, None], release: Callable[[], None]) -> AsyncGenerator[str, None]:
+    try:
+        async for event in r:
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    except Exception as e:
+        logging.exception("Exception while generating response stream")
+        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+    finally:
+        # A streamed answer holds its admission slot until the last event is sent or the client goes away
+        release()
 
 
 @bp.route("/chat", methods=["POST"])
@@ -80,6 +95,12 @@ async def chat():
     context = request_json.get("context", {})
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    try:
+        release = await current_app.config[CONFIG_ADMISSION].acquire(context["auth_claims"].get("oid"))
+    except AdmissionRejectedError as e:
+        logging.warning("Rejecting /chat: %s", e)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    streaming = False
     try:
         approach = current_app.config[CONFIG_CHAT_APPROACH]
         result = await approach.run(
@@ -91,12 +112,66 @@ async def chat():
         if isinstance(result, dict):
             return jsonify(result)
         else:
-            response = await make_response(format_as_ndjson(result))
+            body = format_as_ndjson(result, release)
+            # Also give the slot back if the client disconnects before the body is ever iterated
+            weakref.finalize(body, release)
+            response = await make_response(body)
             response.timeout = None  # type: ignore
+            streaming = True
             return response
+    except QueryQueueFullError as e:
+        logging.warning("Rejecting /chat, database queue is full: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
+    finally:
+        if not streaming:
+            release()
+
+
+# Next page of a truncated /chat result, only the database is queried again
+@bp.route("/chat/next", methods=["POST"])
+async def chat_next():
+    if not request.is_json:
+        return jsonify({"error": "request must be json"}), 415
+    request_json = await request.get_json()
+    continuation_token = request_json.get("continuation_token")
+    if not continuation_token:
+        return jsonify({"error": "continuation_token is required"}), 400
+    auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
+    auth_claims = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    # A page holds a query thread and a pooled connection, so it counts against the same limits as /chat
+    try:
+        release = await current_app.config[CONFIG_ADMISSION].acquire(auth_claims.get("oid"))
+    except AdmissionRejectedError as e:
+        logging.warning("Rejecting /chat/next: %s", e)
+        return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+    try:
+        approach = current_app.config[CONFIG_CHAT_APPROACH]
+        return jsonify(await approach.get_next_page(continuation_token, auth_claims))
+    except InvalidContinuationError as e:
+        return jsonify({"error": str(e)}), 404
+    except QueryRejectedError as e:
+        return jsonify({"error": str(e), "guard": e.decision}), 422
+    except QueryQueueFullError as e:
+        logging.warning("Rejecting /chat/next, database queue is full: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        logging.exception("Exception in /chat/next")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        release()
+
+
+# Stage latencies, cache and pool statistics of this worker in the Prometheus text format
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    current_app.config[CONFIG_CHAT_APPROACH].report_metrics()
+    admission = current_app.config[CONFIG_ADMISSION]
+    metrics.set_gauge("chat_requests", {"state": "in_flight"}, admission.in_flight)
+    metrics.set_gauge("chat_requests", {"state": "queued"}, admission.queued)
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 
 # Send MSAL.js settings to the client UI
@@ -140,6 +215,44 @@ async def setup_clients():
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
     TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH")
+    AUTH_CLAIMS_CACHE_SIZE = int(os.getenv("AUTH_CLAIMS_CACHE_SIZE", "1024"))
+    AUTH_GROUPS_CACHE_TTL = float(os.getenv("AUTH_GROUPS_CACHE_TTL", "3600"))
+    AUTH_GROUPS_REFRESH_INTERVAL = float(os.getenv("AUTH_GROUPS_REFRESH_INTERVAL", "300"))
+    # Per-worker SQL connection pool
+    SQL_POOL_MIN_SIZE = int(os.getenv("SQL_POOL_MIN_SIZE", "1"))
+    SQL_POOL_MAX_SIZE = int(os.getenv("SQL_POOL_MAX_SIZE", "10"))
+    SQL_POOL_IDLE_TIMEOUT = float(os.getenv("SQL_POOL_IDLE_TIMEOUT", "300"))
+    SQL_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv("SQL_POOL_HEALTH_CHECK_INTERVAL", "30"))
+    # Dedicated threads for blocking database calls
+    SQL_EXECUTOR_WORKERS = int(os.getenv("SQL_EXECUTOR_WORKERS", str(SQL_POOL_MAX_SIZE)))
+    SQL_EXECUTOR_QUEUE_DEPTH = int(os.getenv("SQL_EXECUTOR_QUEUE_DEPTH", "50"))
+    SQL_QUERY_TIMEOUT = int(os.getenv("SQL_QUERY_TIMEOUT", "60"))
+    # Highest optimizer cost estimate a generated query may have, 0 turns the plan check off
+    SQL_QUERY_MAX_COST = float(os.getenv("SQL_QUERY_MAX_COST", "1000"))
+    # Check generated SQL against the schema before running it, invalid SQL gets this many fixSql re-prompts
+    SQL_VALIDATION = os.getenv("SQL_VALIDATION", "true").lower() == "true"
+    SQL_REPAIR_ATTEMPTS = int(os.getenv("SQL_REPAIR_ATTEMPTS", "1"))
+    SCHEMA_CHECK_INTERVAL = float(os.getenv("SCHEMA_CHECK_INTERVAL", "60"))
+    SCHEMA_TOP_K = int(os.getenv("SCHEMA_TOP_K", "25"))
+    PLUGIN_AUTO_RELOAD = os.getenv("PLUGIN_AUTO_RELOAD", "").lower() == "true"
+    TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "1024"))
+    TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", "3600"))
+    RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "256"))
+    RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
+    # Optional cache shared by all workers, e.g. sqlite:////tmp/data-chat-cache.db or rediss://:key@host:6380/0
+    SHARED_CACHE_URL = os.getenv("SHARED_CACHE_URL")
+    # Signs continuation tokens, set the same value on every instance. gunicorn.conf.py sets one for its workers.
+    CONTINUATION_SECRET = os.getenv("CONTINUATION_SECRET")
+    CONTINUATION_TTL = float(os.getenv("CONTINUATION_TTL", "900"))
+    # Identical /chat requests that arrive while one is running share its answer
+    CHAT_COALESCE_REQUESTS = os.getenv("CHAT_COALESCE_REQUESTS", "true").lower() == "true"
+    # Generate the SQL and its explanation in one completion, requests can override it with single_round_trip
+    SINGLE_ROUND_TRIP = os.getenv("SINGLE_ROUND_TRIP", "").lower() == "true"
+    # Per-worker admission control for /chat and /chat/next, requests over the limits get 429 with Retry-After
+    CHAT_MAX_IN_FLIGHT = int(os.getenv("CHAT_MAX_IN_FLIGHT", "32"))
+    CHAT_MAX_PER_USER = int(os.getenv("CHAT_MAX_PER_USER", "4"))
+    CHAT_MAX_QUEUE = int(os.getenv("CHAT_MAX_QUEUE", "64"))
+    CHAT_MAX_WAIT = float(os.getenv("CHAT_MAX_WAIT", "30"))
 
     # Use the current user identity to authenticate with Azure OpenAI, Cognitive Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
@@ -155,10 +268,19 @@ async def setup_clients():
         client_app_id=AZURE_CLIENT_APP_ID,
         tenant_id=AZURE_TENANT_ID,
         token_cache_path=TOKEN_CACHE_PATH,
+        claims_cache_size=AUTH_CLAIMS_CACHE_SIZE,
+        groups_cache_ttl=AUTH_GROUPS_CACHE_TTL,
+        groups_refresh_interval=AUTH_GROUPS_REFRESH_INTERVAL,
     )
 
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
+    current_app.config[CONFIG_ADMISSION] = AdmissionController(
+        max_in_flight=CHAT_MAX_IN_FLIGHT,
+        max_per_user=CHAT_MAX_PER_USER,
+        max_queue=CHAT_MAX_QUEUE,
+        max_wait=CHAT_MAX_WAIT,
+    )
 
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
@@ -175,8 +297,43 @@ async def setup_clients():
         AZURE_OPENAI_API_KEY,
         AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         OPENAI_CHATGPT_MODEL,
-        SQL_CONNECTION_STRING
+        SQL_CONNECTION_STRING,
+        pool_min_size=SQL_POOL_MIN_SIZE,
+        pool_max_size=SQL_POOL_MAX_SIZE,
+        pool_idle_timeout=SQL_POOL_IDLE_TIMEOUT,
+        pool_health_check_interval=SQL_POOL_HEALTH_CHECK_INTERVAL,
+        executor_max_workers=SQL_EXECUTOR_WORKERS,
+        executor_max_queue_depth=SQL_EXECUTOR_QUEUE_DEPTH,
+        query_timeout=SQL_QUERY_TIMEOUT,
+        query_max_cost=SQL_QUERY_MAX_COST,
+        schema_check_interval=SCHEMA_CHECK_INTERVAL,
+        schema_top_k=SCHEMA_TOP_K,
+        plugin_auto_reload=PLUGIN_AUTO_RELOAD,
+        translation_cache_size=TRANSLATION_CACHE_SIZE,
+        translation_cache_ttl=TRANSLATION_CACHE_TTL,
+        result_cache_size=RESULT_CACHE_SIZE,
+        result_cache_ttl=RESULT_CACHE_TTL,
+        shared_cache=create_shared_cache(SHARED_CACHE_URL),
+        continuation_secret=CONTINUATION_SECRET,
+        continuation_ttl=CONTINUATION_TTL,
+        coalesce_requests=CHAT_COALESCE_REQUESTS,
+        single_round_trip=SINGLE_ROUND_TRIP,
+        sql_validation=SQL_VALIDATION,
+        sql_repair_attempts=SQL_REPAIR_ATTEMPTS,
     )
+    current_app.config[CONFIG_CHAT_APPROACH].setup_kernel()
+    current_app.add_background_task(current_app.config[CONFIG_CHAT_APPROACH].warm_up)
+
+
+@bp.after_app_serving
+async def close_clients():
+    await current_app.config[CONFIG_AUTH_CLIENT].close()
+    chat_approach = current_app.config[CONFIG_CHAT_APPROACH]
+    chat_approach.query_executor.shutdown()
+    chat_approach.connection_pool.close()
+    chat_approach.token_manager.close()
+    if chat_approach.shared_cache is not None:
+        await chat_approach.shared_cache.close()
 
 
 def create_app():
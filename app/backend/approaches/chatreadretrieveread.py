@@ -1,22 +1,40 @@
+import asyncio
+import contextlib
+import json
 import re
 import logging
-from typing import Any, AsyncGenerator, Optional, Union
+import os
+import secrets
+import time
+import unicodedata
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Optional, Union
 
-import aiohttp
 import openai
 import semantic_kernel as sk
 from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
 from semantic_kernel.functions import KernelArguments
 import pyodbc
-import os
-import time
-import tempfile
-import struct
 
 from azure.identity import DefaultAzureCredential
+from opentelemetry import trace
 from approaches.approach import Approach
+from core.cache import LRUCache, fingerprint
+from core.sharedcache import SharedCache, TieredCache
 from core.messagebuilder import MessageBuilder
+from core.metrics import metrics
+from core.pagination import InvalidContinuationError, decode_continuation, encode_continuation, fetch_page, paged_sql
+from core.resultformat import RESULT_FORMATS, render_arrow, render_columnar, render_markdown_table, render_scalar
+from core.schemacatalog import SchemaCatalog
+from core.schemaindex import SchemaIndex
+from core.singleflight import SingleFlight, StreamFlight
+from core.sqlexecutor import QueryExecutor, QueryQueueFullError
+from core.sqlguard import QueryGuard, QueryRejectedError
+from core.sqlvalidator import SqlValidationError, SqlValidator
+from core.sqlpool import ConnectionPool
+from core.sqltoken import SQL_COPT_SS_ACCESS_TOKEN, SqlTokenManager
 from core.modelhelper import get_token_limit
+from core.modelhelper import get_schema_token_limit
+from core.modelhelper import num_tokens_from_string
 from core.modelhelper import get_database_name
 from text import nonewlines
 
@@ -28,6 +46,16 @@ class ChatReadRetrieveReadApproach(Approach):
 
     NO_RESPONSE = "0"
 
+    EXPLANATION_UNAVAILABLE = "An explanation for this query could not be generated."
+    SQL_NOT_RUN = "The generated query was not run because it did not pass validation."
+
+    plugins_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins")
+    plugin_name = "QueryPlugin"
+    # How often plugin_auto_reload looks at the prompt files
+    plugin_reload_check_interval = 5
+    # Schema entries in the shared cache are keyed by version, this only bounds how long stale versions linger
+    schema_shared_ttl = 24 * 60 * 60
+
     """
     Simple retrieve-then-read implementation, using the Cognitive Search and OpenAI APIs directly. It first retrieves
     top documents from search, then constructs a prompt with them, and then uses OpenAI to generate an completion
@@ -42,6 +70,25 @@ class ChatReadRetrieveReadApproach(Approach):
         GROUP BY t.TABLE_SCHEMA, t.TABLE_NAME
     """
 
+    # Views and synonyms aren't sent to the prompts, but generated queries may use them
+    schema_objects_query = """
+        SELECT concat(v.TABLE_SCHEMA, '.', v.TABLE_NAME, ' (', string_agg(c.COLUMN_NAME, ', '), ')')
+        FROM INFORMATION_SCHEMA.VIEWS as v,
+        INFORMATION_SCHEMA.COLUMNS as c
+        WHERE v.TABLE_SCHEMA = c.TABLE_SCHEMA AND v.TABLE_NAME = c.TABLE_NAME
+        GROUP BY v.TABLE_SCHEMA, v.TABLE_NAME
+        UNION ALL
+        SELECT concat(SCHEMA_NAME(schema_id), '.', name) FROM sys.synonyms
+    """
+
+    # Creating, dropping, renaming or altering a table, view or synonym changes its modify_date, so this is enough
+    # to notice schema changes
+    schema_version_query = """
+        SELECT concat(COUNT(*), ':', CHECKSUM_AGG(CHECKSUM(object_id, modify_date)), ':', MAX(modify_date))
+        FROM sys.objects
+        WHERE type IN ('U', 'V', 'SN')
+    """
+
     def __init__(
         self,
         openai_host: str,
@@ -49,7 +96,29 @@ class ChatReadRetrieveReadApproach(Approach):
         azure_openai_key: str,
         chatgpt_deployment: Optional[str],  # Not needed for non-Azure OpenAI
         chatgpt_model: str,
-        connection_string: str
+        connection_string: str,
+        pool_min_size: int = 1,
+        pool_max_size: int = 10,
+        pool_idle_timeout: float = 300,
+        pool_health_check_interval: float = 30,
+        executor_max_workers: int = 10,
+        executor_max_queue_depth: int = 50,
+        query_timeout: int = 60,
+        query_max_cost: float = 1000,
+        schema_check_interval: float = 60,
+        schema_top_k: int = 25,
+        plugin_auto_reload: bool = False,
+        translation_cache_size: int = 1024,
+        translation_cache_ttl: float = 3600,
+        result_cache_size: int = 256,
+        result_cache_ttl: float = 60,
+        shared_cache: Optional[SharedCache] = None,
+        continuation_secret: Optional[str] = None,
+        continuation_ttl: float = 900,
+        coalesce_requests: bool = True,
+        single_round_trip: bool = False,
+        sql_validation: bool = True,
+        sql_repair_attempts: int = 1,
     ):
         self.openai_host = openai_host
         self.azure_openai_url = azure_openai_url
@@ -59,43 +128,221 @@ class ChatReadRetrieveReadApproach(Approach):
         self.connection_string = connection_string
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
         self.database_name = get_database_name(connection_string)
+        self.token_manager = SqlTokenManager(DefaultAzureCredential(exclude_interactive_browser_credential=False))
+        self.connection_pool = ConnectionPool(
+            self.get_conn,
+            min_size=pool_min_size,
+            max_size=pool_max_size,
+            idle_timeout=pool_idle_timeout,
+            health_check_interval=pool_health_check_interval,
+        )
+        self.query_timeout = query_timeout
+        # The server side query timeout fires first; the executor timeout also covers waiting for a pooled connection
+        self.query_executor = QueryExecutor(
+            max_workers=executor_max_workers,
+            max_queue_depth=executor_max_queue_depth,
+            timeout=query_timeout + self.connection_pool.acquire_timeout,
+        )
+        self.query_guard = QueryGuard(max_cost=query_max_cost, timeout=query_timeout)
+        self.schema_catalog = SchemaCatalog(
+            self.load_schema_tables,
+            self.load_schema_version,
+            check_interval=schema_check_interval,
+            load_objects=self.load_schema_objects,
+        )
+        self.schema_top_k = schema_top_k
+        self.schema_index: Optional[SchemaIndex] = None
+        # Generated SQL is checked against the schema catalog before it reaches the database
+        self.sql_validation = sql_validation
+        self.sql_repair_attempts = sql_repair_attempts
+        self.sql_validator: Optional[SqlValidator] = None
+        self.plugin_auto_reload = plugin_auto_reload
+        # Generate the SQL and its explanation in one completion instead of two, the single_round_trip override wins
+        self.single_round_trip = single_round_trip
+        self.kernel: Optional[sk.Kernel] = None
+        self.query_plugin = None
+        self.plugin_mtime = 0.0
+        self.plugin_checked_at = 0.0
+        # Generated SQL and explanation per normalized question, history, database and schema version
+        # Each cache keeps a per-process layer in front of the optional cross-worker shared cache
+        self.shared_cache = shared_cache
+        self.translation_cache = TieredCache(
+            LRUCache(maxsize=translation_cache_size, ttl=translation_cache_ttl), shared_cache, "translation"
+        )
+        # Query results per normalized SQL, row limit and caller identity
+        self.result_cache = TieredCache(LRUCache(maxsize=result_cache_size, ttl=result_cache_ttl), shared_cache, "result")
+        # Continuation tokens carry their own state and are signed, so the next page can be served by any worker
+        # that shares the secret. Without one, tokens are only valid in this process.
+        self.continuation_key = (continuation_secret or secrets.token_hex(32)).encode("utf-8")
+        self.continuation_ttl = continuation_ttl
+        # Identical requests that arrive while one is running share its pipeline instead of starting their own
+        self.coalesce_requests = coalesce_requests
+        self.request_flights = SingleFlight()
+        self.stream_flights = StreamFlight()
+
+    def setup_kernel(self):
+        # One kernel and chat service per worker so the Azure OpenAI HTTP connections are reused across requests
+        self.kernel = sk.Kernel()
+        self.kernel.add_service(
+            AzureChatCompletion(
+                service_id="chat_completion",
+                deployment_name=self.chatgpt_deployment,
+                endpoint=self.azure_openai_url,
+                api_key=self.azure_openai_key
+            ),
+        )
+        self.reload_plugins()
+
+    def get_plugin_mtime(self) -> float:
+        plugin_directory = os.path.join(self.plugins_directory, self.plugin_name)
+        mtime = 0.0
+        for function_name in os.listdir(plugin_directory):
+            for file_name in ("config.json", "skprompt.txt"):
+                path = os.path.join(plugin_directory, function_name, file_name)
+                if os.path.isfile(path):
+                    mtime = max(mtime, os.path.getmtime(path))
+        return mtime
+
+    def reload_plugins(self):
+        """
+        Parses the QueryPlugin prompt functions from disk. Call this to pick up prompt edits without a restart,
+        or set plugin_auto_reload to have changed files reloaded automatically.
+        """
+        mtime = self.get_plugin_mtime()
+        self.query_plugin = self.kernel.add_plugin(parent_directory=self.plugins_directory, plugin_name=self.plugin_name)
+        self.plugin_mtime = mtime
+        self.plugin_checked_at = time.monotonic()
+
+    def get_query_plugin(self):
+        if self.kernel is None:
+            self.setup_kernel()
+        elif self.plugin_auto_reload and time.monotonic() - self.plugin_checked_at >= self.plugin_reload_check_interval:
+            self.plugin_checked_at = time.monotonic()
+            if self.get_plugin_mtime() != self.plugin_mtime:
+                logging.info("QueryPlugin prompts changed on disk, reloading")
+                self.reload_plugins()
+        return self.query_plugin
 
     def get_conn(self):
-        credential = DefaultAzureCredential(exclude_interactive_browser_credential=False)
-        token_bytes = credential.get_token("https://database.windows.net/.default").token.encode("UTF-16-LE")
-        token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
-        SQL_COPT_SS_ACCESS_TOKEN = 1256  # This connection option is defined by microsoft in msodbcsql.h
-        conn = pyodbc.connect(self.connection_string, attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct})
+        token_struct = self.token_manager.get_token_struct()
+        # Only reads run here, autocommit keeps a SELECT from leaving a transaction open on an idle pooled connection
+        conn = pyodbc.connect(
+            self.connection_string, attrs_before={SQL_COPT_SS_ACCESS_TOKEN: token_struct}, autocommit=True
+        )
         return conn
 
-    async def schema_detect(self) -> str:
-        folder = tempfile.gettempdir()
-        schema_cache_file = folder + "/schema.txt"
-        ts = time.time()
-        schema_ttl = 60 * 60 # 1 hour
-        if os.path.isfile(schema_cache_file) and ts - os.path.getmtime(schema_cache_file) < schema_ttl:
-            with open(schema_cache_file, "r") as f:
-                return f.read()
-        else:
-            conn = self.get_conn()
+    async def warm_up(self):
+        try:
+            await self.query_executor.run(self.connection_pool.fill)
+        except Exception:
+            logging.exception("Unable to open the initial SQL connections")
 
+    def fetch_all(self, query: str) -> list:
+        with self.connection_pool.connection() as conn:
+            conn.timeout = self.query_timeout
             cursor = conn.cursor()
-            table_list = ""
             try:
-                cursor.execute(self.schema_query)
-                result = cursor.fetchall()
-                for table in result:
-                    table_list += table[0] + "\n"
-            except:
+                cursor.execute(query)
+                return cursor.fetchall()
+            finally:
                 cursor.close()
-                conn.close()
-                return "No Tables Found"
-            cursor.close()
-            conn.close()
-            with open(schema_cache_file, "w") as f:
-                f.write(table_list)
-            return table_list
-    
+
+    async def load_schema_tables(self, version: str) -> list[str]:
+        # Another worker has usually loaded this schema version already
+        shared_key = f"schema:{fingerprint(self.database_name, version)}"
+        if self.shared_cache is not None:
+            tables = await self.shared_cache.get(shared_key)
+            if tables is not None:
+                return tables
+        result = await self.query_executor.run(self.fetch_all, self.schema_query)
+        tables = [table[0] for table in result]
+        if self.shared_cache is not None:
+            await self.shared_cache.set(shared_key, tables, self.schema_shared_ttl)
+        return tables
+
+    async def load_schema_objects(self, version: str) -> list[str]:
+        result = await self.query_executor.run(self.fetch_all, self.schema_objects_query)
+        return [row[0] for row in result]
+
+    async def load_schema_version(self) -> str:
+        result = await self.query_executor.run(self.fetch_all, self.schema_version_query)
+        return str(result[0][0])
+
+    async def schema_detect(self) -> str:
+        try:
+            return await self.schema_catalog.get()
+        except Exception:
+            logging.exception("Unable to load the database schema")
+            return "No Tables Found"
+
+    async def relevant_schema(self, question: str, token_limit: int) -> str:
+        table_descriptions = await self.schema_detect()
+        if not self.schema_catalog.tables:
+            return table_descriptions
+        if self.schema_index is None or self.schema_index.version != self.schema_catalog.version:
+            self.schema_index = SchemaIndex(self.schema_catalog.tables, version=self.schema_catalog.version)
+        tables = self.schema_index.select(
+            question,
+            top_k=self.schema_top_k,
+            token_limit=token_limit,
+            count_tokens=lambda text: num_tokens_from_string(text, self.chatgpt_model),
+        )
+        return "".join(table + "\n" for table in tables)
+
+    def get_sql_validator(self) -> Optional[SqlValidator]:
+        if not self.sql_validation or not self.schema_catalog.tables:
+            return None
+        if self.sql_validator is None or self.sql_validator.version != self.schema_catalog.version:
+            self.sql_validator = SqlValidator(
+                self.schema_catalog.tables, version=self.schema_catalog.version, objects=self.schema_catalog.objects
+            )
+        return self.sql_validator
+
+    async def validate_sql(
+        self, sql_query: str, question: str, table_descriptions: str, history: str
+    ) -> tuple[str, Optional[SqlValidationError]]:
+        """
+        Checks the generated SQL against the schema catalog. Fixable problems are sent back to the model with
+        fixSql, at most sql_repair_attempts times. Returns the SQL to run and None, or the last SQL and the error
+        that keeps it from running.
+        """
+        validator = self.get_sql_validator()
+        if validator is None:
+            return sql_query, None
+        attempt = 0
+        while True:
+            with metrics.stage("sql_validate") as span:
+                try:
+                    validator.validate(sql_query)
+                    error = None
+                except SqlValidationError as e:
+                    error = e
+                    span.set_attribute("sql_validate.problems", len(e.problems))
+            if error is None:
+                metrics.increment("chat_sql_validation_total", {"status": "repaired" if attempt else "valid"})
+                return sql_query, None
+            logging.info("Generated SQL failed validation: %s", error)
+            if not error.fixable or attempt >= self.sql_repair_attempts:
+                break
+            attempt += 1
+            try:
+                with metrics.stage("sql_repair", attempt=attempt):
+                    response = await self.kernel.invoke(
+                        self.query_plugin["fixSql"],
+                        input=sql_query,
+                        error="\n".join(error.problems),
+                        original_question=question,
+                        table_descriptions=table_descriptions,
+                        database_name=self.database_name,
+                        history=history,
+                    )
+            except Exception:
+                logging.exception("fixSql failed, the query won't be run")
+                break
+            sql_query = str(response).replace("```sql", "").replace("```", "").strip()
+        metrics.increment("chat_sql_validation_total", {"status": "rejected"})
+        return sql_query, error
+
     async def chat_response(self, query_result, commentary) -> any:
         response = ""
         if commentary != None:
@@ -120,52 +367,345 @@ class ChatReadRetrieveReadApproach(Approach):
             ],
         }
 
-    async def get_result_from_database(self, sql_query: str, row_limit: int) -> dict[str, Any]:
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        output = ""
-        result_type = "error"
-        try:
-            cursor.execute(sql_query)
-            if cursor.description[0][0] == '':
-                result_type = "scalar"
-                for row in cursor.fetchall():
-                    for column in row:
-                        output += str(column)
-            else:
-                result_type = "table"
-                row_count = 0
-                column_count = 0
-                
-                output += "| "
-                for column in cursor.description:
-                    output += column[0] + " | "
-                    column_count += 1
-                output += "\n"
-
-                output += "| "
-                for i in range(column_count):
-                    output += "--- | "
-                output += "\n"
-                
-                for row in cursor.fetchall():
-                    output += "| "
-                    for column in row:
-                        output += str(column) + " | "
-                    output += "\n"
-                    row_count += 1
-                    if row_count >= row_limit:
-                        break
-        except Exception as e:
-            logging.exception(str(e))
-            result_type = "error"
-            return str(e)
-        cursor.close()
-        conn.close()
+    def chat_delta(self, content: Optional[str] = None, finish_reason: Optional[str] = None) -> dict[str, Any]:
+        delta = {"role": self.ASSISTANT}
+        if content is not None:
+            delta["content"] = content
         return {
+            "choices": [{"delta": delta, "finish_reason": finish_reason, "index": 0}],
+            "object": "chat.completion.chunk",
+        }
+
+    async def stream_explanation(self, explain_function, explain_arguments: KernelArguments) -> AsyncGenerator[str, None]:
+        with metrics.stage("explain_sql", attach=False, streaming=True) as span:
+            chunk_count = 0
+            async for chunk in self.kernel.invoke_stream(explain_function, explain_arguments):
+                if isinstance(chunk, list) and chunk:
+                    content = str(chunk[0])
+                    if content:
+                        chunk_count += 1
+                        yield content
+            span.set_attribute("explain_sql.chunks", chunk_count)
+
+    async def translate_and_explain(
+        self, question: str, table_descriptions: str, history: str
+    ) -> Optional[dict[str, Optional[str]]]:
+        """
+        Asks nlpToSqlExplained for the SQL and its explanation in one completion, so the table descriptions and
+        history are sent once. Returns None when the call fails or no SQL can be read from the answer, the caller
+        then falls back to nlpToSql and explainSql.
+        """
+        with metrics.stage("nlp_to_sql_explained") as span:
+            try:
+                response = await self.kernel.invoke(
+                    self.query_plugin["nlpToSqlExplained"],
+                    input=question,
+                    table_descriptions=table_descriptions,
+                    database_name=self.database_name,
+                    history=history,
+                )
+                translation = self.parse_sql_and_explanation(str(response))
+            except Exception:
+                logging.exception("nlpToSqlExplained failed, falling back to nlpToSql and explainSql")
+                translation = None
+            if translation is None:
+                status = "fallback"
+            else:
+                status = "parsed" if translation["explanation"] is not None else "sql_only"
+            span.set_attribute("nlp_to_sql_explained.status", status)
+        metrics.increment("chat_single_round_trip_total", {"status": status})
+        return translation
+
+    @staticmethod
+    def parse_sql_and_explanation(response: str) -> Optional[dict[str, Optional[str]]]:
+        # Models sometimes wrap the object in code fences or add a sentence around it, so take the first
+        # JSON object that has a non-empty "sql" string wherever it starts
+        decoder = json.JSONDecoder()
+        position = response.find("{")
+        while position != -1:
+            try:
+                value, _ = decoder.raw_decode(response, position)
+            except ValueError:
+                value = None
+            if isinstance(value, dict) and isinstance(value.get("sql"), str):
+                sql = value["sql"].replace("```sql", "").replace("```", "").strip()
+                if sql:
+                    explanation = value.get("explanation")
+                    if not isinstance(explanation, str) or not explanation.strip():
+                        explanation = None
+                    return {"sql": sql, "explanation": explanation and explanation.strip()}
+            position = response.find("{", position + 1)
+        return None
+
+    async def timed(self, stage: str, awaitable: Awaitable) -> Any:
+        with metrics.stage(stage):
+            return await awaitable
+
+    async def cached_explanation(self, explanation: str) -> AsyncGenerator[str, None]:
+        yield explanation
+
+    async def chat_response_stream(
+        self, explanation_chunks: AsyncIterator[str], query: Awaitable[dict[str, Any]], sql_query: str,
+        msg_to_display: str, translation_key: Optional[str] = None,
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        # The explanation only needs the SQL, so run the query while the explanation streams
+        query_task = asyncio.ensure_future(query)
+        try:
+            explanation = []
+            try:
+                async for content in explanation_chunks:
+                    explanation.append(content)
+                    yield self.chat_delta(content)
+                if translation_key is not None:
+                    await self.translation_cache.set(translation_key, {"sql": sql_query, "explanation": "".join(explanation)})
+            except Exception:
+                logging.exception("explainSql failed, returning the query result without an explanation")
+                yield self.chat_delta(self.EXPLANATION_UNAVAILABLE)
+
+            yield self.chat_delta("\n```sql\n" + sql_query + "\n```")
+
+            query_result = await query_task
+        finally:
+            # The client went away or the query failed outright, don't leave the query running unobserved
+            if not query_task.done():
+                query_task.cancel()
+
+        yield self.chat_delta("\n### Results Returned\n")
+        for line in query_result["result"].splitlines(keepends=True):
+            yield self.chat_delta(line)
+
+        # Repeat the context now that the result is known, clients keep the last one they receive
+        final_event = self.chat_delta(finish_reason="stop")
+        final_event["choices"][0]["context"] = {
+            "data_points": [],
+            "thoughts": self.get_thoughts(sql_query, query_result, msg_to_display),
+            "result_cache": query_result["cache"],
+        }
+        if "structured" in query_result:
+            final_event["choices"][0]["context"]["result"] = query_result["structured"]
+        if "continuation_token" in query_result:
+            final_event["choices"][0]["context"]["continuation_token"] = query_result["continuation_token"]
+        yield final_event
+
+    async def explain_and_query(self, explanation: Awaitable, query: Awaitable[dict[str, Any]]) -> tuple:
+        """
+        Runs the explainSql completion and the database query at the same time. A failed explanation is replaced
+        by a short note because the result is still useful on its own. If the query itself raises (for example
+        the database queue is full) the explanation is cancelled and the error propagates.
+        """
+        explanation_task = asyncio.ensure_future(explanation)
+        query_task = asyncio.ensure_future(query)
+        try:
+            query_result = await query_task
+        except BaseException:
+            explanation_task.cancel()
+            query_task.cancel()
+            raise
+        try:
+            explanation_response = await explanation_task
+        except Exception:
+            logging.exception("explainSql failed, returning the query result without an explanation")
+            explanation_response = self.EXPLANATION_UNAVAILABLE
+        return explanation_response, query_result
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        # Case is folded outside quoted spans only. Like in normalize_sql, it matters for literals under case
+        # sensitive collations, so "orders for 'ACME'" and "orders for 'acme'" get their own SQL.
+        # An apostrophe inside a word, as in "what's", doesn't start a quoted span.
+        parts = re.split(r"""((?<!\w)'[^']*'(?!\w)|"[^"]*"|“[^”]*”)""", unicodedata.normalize("NFKC", question))
+        question = "".join(part if index % 2 else part.casefold() for index, part in enumerate(parts))
+        return " ".join(question.split()).rstrip("?!. ")
+
+    def get_translation_key(self, question: str, messages: list) -> str:
+        # Everything except the system message and the question itself is history the generated SQL may depend on
+        history_fingerprint = fingerprint([(message["role"], message["content"]) for message in messages[1:-1]])
+        return fingerprint(
+            self.normalize_question(question), history_fingerprint, self.database_name, self.schema_catalog.version
+        )
+
+    def get_thoughts(self, sql_query: str, query_result: Optional[dict[str, Any]], msg_to_display: str) -> str:
+        # The rows are already in the answer, the thoughts only describe how they were produced
+        thoughts = f"Query:<br>{sql_query}<br><br>"
+        if query_result is not None:
+            more = ", more available" if query_result["has_more"] else ""
+            thoughts += f"Result:<br>{query_result['type']}, {query_result['row_count']} rows{more}<br><br>"
+            if "guard" in query_result:
+                guard = query_result["guard"]
+                cost = "unknown" if guard["estimated_cost"] is None else f"{guard['estimated_cost']:.2f}"
+                thoughts += (
+                    f"Guard:<br>{guard['action']}, estimated cost {cost} (limit {guard['max_cost']:g}), "
+                    f"row cap {guard['row_cap']}, timeout {guard['timeout']}s<br><br>"
+                )
+        return thoughts + "Conversations:<br>" + msg_to_display.replace("\n", "<br>")
+
+    def execute_query(
+        self, sql_query: str, row_limit: int, result_format: str = "markdown", offset: int = 0
+    ) -> dict[str, Any]:
+        # Later pages are cut on the server when the statement allows it, otherwise the rows before them are skipped
+        server_paged_query = paged_sql(sql_query, offset, row_limit) if offset else None
+        statement = server_paged_query or sql_query
+        # One row more than the page tells whether there are more, skipped rows count against the cap too
+        row_cap = row_limit + 1 if server_paged_query else offset + row_limit + 1
+        with contextlib.ExitStack() as stack:
+            with metrics.stage("connection_acquire"):
+                conn = stack.enter_context(self.connection_pool.connection())
+            conn.timeout = self.query_timeout
+            with metrics.stage("query_guard") as span:
+                guard = self.query_guard.check(conn, statement, row_cap)
+                span.set_attribute("query_guard.action", guard["action"])
+            with self.query_guard.limits(conn, row_cap):
+                cursor = conn.cursor()
+                try:
+                    with metrics.stage("query_execute", server_paged=server_paged_query is not None):
+                        cursor.execute(statement)
+                    with metrics.stage("fetch") as span:
+                        rows, has_more = fetch_page(cursor, offset, row_limit, server_paged_query is not None)
+                        span.set_attribute("fetch.rows", len(rows))
+                    description = cursor.description
+                finally:
+                    cursor.close()
+        with metrics.stage("render", result_format=result_format):
+            query_result = self.render_result(rows, has_more, description, result_format)
+        query_result["guard"] = guard
+        return query_result
+
+    @staticmethod
+    def render_result(rows: list, has_more: bool, description: Any, result_format: str) -> dict[str, Any]:
+        if description[0][0] == '':
+            result_type = "scalar"
+            output = render_scalar(rows)
+        else:
+            result_type = "table"
+            output = render_markdown_table([column[0] for column in description], rows)
+        query_result = {
             "result": output,
-            "type": result_type
+            "type": result_type,
+            "row_count": len(rows),
+            "has_more": has_more,
         }
+        # The markdown is still rendered for the answer text, structured formats are for clients that process the rows
+        if result_format == "columnar":
+            query_result["structured"] = render_columnar(description, rows)
+        elif result_format == "arrow":
+            query_result["structured"] = render_arrow(description, rows)
+        return query_result
+
+    @staticmethod
+    def normalize_sql(sql_query: str) -> str:
+        # Collapse whitespace outside string literals and drop a trailing semicolon, case is left alone
+        # because it matters inside literals and for case sensitive collations
+        parts = re.split(r"('(?:[^']|'')*')", sql_query.strip().rstrip(";").strip())
+        return "".join(part if index % 2 else " ".join(part.split()) for index, part in enumerate(parts))
+
+    def get_result_key(
+        self, sql_query: str, row_limit: int, auth_claims: dict[str, Any], result_format: str = "markdown"
+    ) -> tuple:
+        # Results are only shared between callers with the same identity and group memberships
+        return (
+            fingerprint(self.database_name, self.normalize_sql(sql_query)),
+            row_limit,
+            self.get_claims_fingerprint(auth_claims),
+            result_format,
+        )
+
+    @staticmethod
+    def get_claims_fingerprint(auth_claims: dict[str, Any]) -> str:
+        return fingerprint(auth_claims.get("oid"), sorted(auth_claims.get("groups") or []))
+
+    async def invalidate_result_cache(self, sql_query: Optional[str] = None):
+        if sql_query is None:
+            await self.result_cache.clear()
+        else:
+            sql_fingerprint = fingerprint(self.database_name, self.normalize_sql(sql_query))
+            await self.result_cache.delete_where(lambda key: key[0] == sql_fingerprint)
+
+    async def get_result_from_database(
+        self,
+        sql_query: str,
+        row_limit: int,
+        auth_claims: dict[str, Any] = {},
+        cache_mode: str = "use",
+        result_format: str = "markdown",
+    ) -> dict[str, Any]:
+        """
+        Runs the query, going through the result cache. cache_mode is "use" to read and fill the cache,
+        "refresh" to skip the read but store the new result, or "bypass" to leave the cache alone.
+        result_format "columnar" or "arrow" adds a structured copy of the rows under "structured".
+        A truncated result comes with a "continuation_token" for get_next_page.
+        """
+        result_key = self.get_result_key(sql_query, row_limit, auth_claims, result_format)
+        query_result = None
+        if cache_mode == "use":
+            query_result = await self.result_cache.get(result_key)
+            metrics.increment(
+                "chat_cache_lookups_total", {"cache": "result", "status": "miss" if query_result is None else "hit"}
+            )
+        trace.get_current_span().set_attribute("result_cache.hit_rate", self.result_cache.stats()["hit_rate"])
+        if query_result is not None:
+            query_result = {**query_result, "cache": "hit"}
+        else:
+            try:
+                query_result = await self.query_executor.run(self.execute_query, sql_query, row_limit, result_format)
+            except QueryQueueFullError:
+                raise
+            except QueryRejectedError as e:
+                logging.warning("Query rejected by the guard: %s", e.decision)
+                return {
+                    "result": str(e), "type": "rejected", "row_count": 0, "has_more": False, "cache": "miss",
+                    "guard": e.decision,
+                }
+            except Exception as e:
+                logging.exception(str(e))
+                return {"result": str(e), "type": "error", "row_count": 0, "has_more": False, "cache": "miss"}
+            if cache_mode != "bypass":
+                await self.result_cache.set(result_key, query_result)
+            query_result = {**query_result, "cache": "miss" if cache_mode == "use" else cache_mode}
+        if query_result["has_more"]:
+            query_result["continuation_token"] = await self.create_continuation(
+                sql_query, row_limit, row_limit, auth_claims, result_format
+            )
+        return query_result
+
+    async def create_continuation(
+        self, sql_query: str, offset: int, page_size: int, auth_claims: dict[str, Any], result_format: str
+    ) -> str:
+        # The signature keeps clients from changing the SQL, and the claims fingerprint binds the token to its caller
+        return encode_continuation(
+            {
+                "sql": sql_query,
+                "offset": offset,
+                "page_size": page_size,
+                "claims": self.get_claims_fingerprint(auth_claims),
+                "result_format": result_format,
+            },
+            self.continuation_key,
+            self.continuation_ttl,
+        )
+
+    async def get_next_page(self, continuation_token: str, auth_claims: dict[str, Any]) -> dict[str, Any]:
+        """
+        Fetches the page a continuation token points to. Only the database is queried, the generated SQL is reused.
+        """
+        continuation = decode_continuation(continuation_token, self.continuation_key)
+        if continuation["claims"] != self.get_claims_fingerprint(auth_claims):
+            raise InvalidContinuationError("The continuation token belongs to another user")
+        query_result = await self.query_executor.run(
+            self.execute_query,
+            continuation["sql"],
+            continuation["page_size"],
+            continuation["result_format"],
+            continuation["offset"],
+        )
+        if query_result["has_more"]:
+            query_result["continuation_token"] = await self.create_continuation(
+                continuation["sql"],
+                continuation["offset"] + continuation["page_size"],
+                continuation["page_size"],
+                auth_claims,
+                continuation["result_format"],
+            )
+        return query_result
 
     async def run_until_final_call(
         self,
@@ -177,61 +717,144 @@ class ChatReadRetrieveReadApproach(Approach):
         top = overrides.get("top", 10)
         original_user_query = history[-1]["content"]
 
-        # Initialize the kernel
-        kernel = sk.Kernel()
-
-        kernel.add_service(
-            AzureChatCompletion(
-                service_id="chat_completion",
-                deployment_name=self.chatgpt_deployment,
-                endpoint=self.azure_openai_url,
-                api_key=self.azure_openai_key
-            ),
-        )
-
-        plugins_directory = "./approaches/plugins"
-
-        query_plugin = kernel.add_plugin(
-            parent_directory=plugins_directory, plugin_name="QueryPlugin"
-        )
+        query_plugin = self.get_query_plugin()
+        kernel = self.kernel
 
         response_token_limit = 1024
-        messages_token_limit = self.chatgpt_token_limit - response_token_limit
-        messages = self.get_messages_from_history(
-            system_prompt="None",
-            model_id=self.chatgpt_model,
-            history=history,
-            # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            user_content=original_user_query,
-            max_tokens=messages_token_limit,
-        )
+        # Rank tables against the latest user turns so follow up questions keep the tables they refer to
+        schema_question = " ".join(message["content"] for message in history[-3:] if message["role"] == self.USER)
+        with metrics.stage("schema") as span:
+            table_descriptions = await self.relevant_schema(
+                schema_question, get_schema_token_limit(self.chatgpt_model, response_token_limit)
+            )
+            schema_token_count = num_tokens_from_string(table_descriptions, self.chatgpt_model)
+            span.set_attribute("schema.tokens", schema_token_count)
+        messages_token_limit = self.chatgpt_token_limit - response_token_limit - schema_token_count
+        with metrics.stage("history", history_messages=len(history)):
+            messages = self.get_messages_from_history(
+                system_prompt="None",
+                model_id=self.chatgpt_model,
+                history=history,
+                # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
+                user_content=original_user_query,
+                max_tokens=messages_token_limit,
+            )
 
         msg_to_display = "\n".join([str(message) for message in messages])
 
-        query_response = await kernel.invoke(query_plugin["nlpToSql"], input=original_user_query, 
-                                        table_descriptions=await self.schema_detect(), 
-                                        database_name=self.database_name, 
-                                        history=msg_to_display)
-        
-        query_deformatted = str(query_response).replace("```sql", "").replace("```", "").strip()
-        
-        explanation_response = await kernel.invoke(query_plugin["explainSql"], input=str(query_deformatted), 
-                                        original_question=original_user_query,
-                                        table_descriptions=await self.schema_detect(), 
-                                        database_name=self.database_name, 
-                                        history=msg_to_display)
+        translation_key = self.get_translation_key(original_user_query, messages)
+        translation = None
+        if overrides.get("skip_translation_cache"):
+            translation_cache_status = "bypass"
+        else:
+            translation = await self.translation_cache.get(translation_key)
+            translation_cache_status = "hit" if translation else "miss"
+        metrics.increment("chat_cache_lookups_total", {"cache": "translation", "status": translation_cache_status})
+        request_span = trace.get_current_span()
+        request_span.set_attribute("translation_cache.status", translation_cache_status)
+        request_span.set_attribute("translation_cache.hit_rate", self.translation_cache.stats()["hit_rate"])
+
+        combined = None
+        if not translation and overrides.get("single_round_trip", self.single_round_trip):
+            combined = await self.translate_and_explain(original_user_query, table_descriptions, msg_to_display)
+
+        if translation:
+            query_deformatted = translation["sql"]
+            explanation_text = translation["explanation"]
+        elif combined:
+            query_deformatted = combined["sql"]
+            # Without an explanation in the answer, explainSql still runs below
+            explanation_text = combined["explanation"]
+        else:
+            explanation_text = None
+            with metrics.stage("nlp_to_sql") as span:
+                query_response = await kernel.invoke(query_plugin["nlpToSql"], input=original_user_query, 
+                                                table_descriptions=table_descriptions, 
+                                                database_name=self.database_name, 
+                                                history=msg_to_display)
+
+                query_deformatted = str(query_response).replace("```sql", "").replace("```", "").strip()
+                span.set_attribute(
+                    "nlp_to_sql.completion_tokens", num_tokens_from_string(query_deformatted, self.chatgpt_model)
+                )
 
         logging.info(f"Query Response: {query_deformatted}")
 
-        query_result = None
+        validated_query, validation_error = await self.validate_sql(
+            query_deformatted, original_user_query, table_descriptions, msg_to_display
+        )
+        if validated_query != query_deformatted:
+            # Cache the repaired query, an explanation that came with the translation was for the old one
+            query_deformatted = validated_query
+            explanation_text = None
+            translation = None
+        if validation_error is not None:
+            explanation_text = self.SQL_NOT_RUN
+            translation = None
+            translation_key = None
+
+        if overrides.get("skip_result_cache"):
+            result_cache_mode = "bypass"
+        elif overrides.get("refresh_result_cache"):
+            result_cache_mode = "refresh"
+        else:
+            result_cache_mode = "use"
+        result_format = overrides.get("result_format", "markdown")
+        if result_format not in RESULT_FORMATS:
+            result_format = "markdown"
 
-        query_result = await self.get_result_from_database(str(query_deformatted), top)
+        explain_arguments = KernelArguments(input=str(query_deformatted),
+                                        original_question=original_user_query,
+                                        table_descriptions=table_descriptions,
+                                        database_name=self.database_name,
+                                        history=msg_to_display)
+
+        if validation_error is not None:
+            # Invalid SQL isn't sent to the database and isn't cached, the error goes where the rows would be
+            query = asyncio.sleep(0, result={
+                "result": str(validation_error), "type": "invalid", "row_count": 0, "has_more": False, "cache": "miss",
+            })
+        else:
+            query = self.get_result_from_database(
+                str(query_deformatted), top, auth_claims, result_cache_mode, result_format
+            )
+
+        if should_stream:
+            # Send the generated SQL right away, the explanation and rows follow as they become available
+            extra_info = {
+                "data_points": [],
+                "thoughts": self.get_thoughts(query_deformatted, None, msg_to_display),
+                "translation_cache": translation_cache_status,
+            }
+            if explanation_text is not None:
+                explanation_chunks = self.cached_explanation(explanation_text)
+            else:
+                explanation_chunks = self.stream_explanation(query_plugin["explainSql"], explain_arguments)
+            chat_coroutine = self.chat_response_stream(
+                explanation_chunks, query, query_deformatted, msg_to_display,
+                translation_key=None if translation else translation_key,
+            )
+            return (extra_info, chat_coroutine)
+
+        if explanation_text is not None:
+            explanation = asyncio.sleep(0, result=explanation_text)
+        else:
+            explanation = self.timed("explain_sql", kernel.invoke(query_plugin["explainSql"], explain_arguments))
+        explanation_response, query_result = await self.explain_and_query(explanation, query)
+        if translation_key is not None and not translation and explanation_response is not self.EXPLANATION_UNAVAILABLE:
+            await self.translation_cache.set(translation_key, {"sql": query_deformatted, "explanation": str(explanation_response)})
 
+        # The rows are sent once, in the answer, plus the structured copy when one was asked for
         extra_info = {
-            "data_points": query_result["result"],
-            "thoughts": f"Query:<br>{query_result}<br><br>Conversations:<br>"
-            + msg_to_display.replace("\n", "<br>"),
+            "data_points": [],
+            "thoughts": self.get_thoughts(query_deformatted, query_result, msg_to_display),
+            "translation_cache": translation_cache_status,
+            "result_cache": query_result["cache"],
         }
+        if "structured" in query_result:
+            extra_info["result"] = query_result["structured"]
+        if "continuation_token" in query_result:
+            extra_info["continuation_token"] = query_result["continuation_token"]
 
         commentary = str(explanation_response) + "\n```sql\n" + str(query_deformatted) + "\n```"
 
@@ -276,20 +899,54 @@ class ChatReadRetrieveReadApproach(Approach):
             "object": "chat.completion.chunk",
         }
 
-        async for event in await chat_coroutine:
-            # "2023-07-01-preview" API version has a bug where first response has empty choices
-            if event["choices"]:
-                yield event
+        async for event in chat_coroutine:
+            yield event
+
+    def get_flight_key(self, messages: list[dict], overrides: dict[str, Any], auth_claims: dict[str, Any]) -> str:
+        # Same question, history, database, options and caller identity means the same answer
+        history_fingerprint = fingerprint([(message["role"], message["content"]) for message in messages[:-1]])
+        return fingerprint(
+            self.normalize_question(messages[-1]["content"]),
+            history_fingerprint,
+            self.database_name,
+            overrides,
+            self.get_claims_fingerprint(auth_claims),
+        )
+
+    @staticmethod
+    def with_session_state(event: dict[str, Any], session_state: Any) -> dict[str, Any]:
+        # Coalesced callers share one response, so each gets a copy carrying its own session state
+        choice = event["choices"][0]
+        if "session_state" not in choice:
+            return event
+        return {**event, "choices": [{**choice, "session_state": session_state}, *event["choices"][1:]]}
+
+    async def coalesced_stream(self, key: str, start, session_state: Any) -> AsyncGenerator[dict[str, Any], None]:
+        if self.stream_flights.is_shared(key):
+            metrics.increment("chat_coalesced_requests_total", {"mode": "stream"})
+        async for event in self.stream_flights.subscribe(key, start):
+            yield self.with_session_state(event, session_state)
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        async with aiohttp.ClientSession() as s:
-            # openai.aiosession.set(s)
-            response = await self.run_without_streaming(messages, overrides, auth_claims, session_state)
-        return response
+        if not self.coalesce_requests:
+            if stream:
+                return self.run_with_streaming(messages, overrides, auth_claims, session_state)
+            return await self.run_without_streaming(messages, overrides, auth_claims, session_state)
+        key = self.get_flight_key(messages, overrides, auth_claims)
+        if stream:
+            return self.coalesced_stream(
+                key, lambda: self.run_with_streaming(messages, overrides, auth_claims), session_state
+            )
+        response, shared = await self.request_flights.do(
+            key, lambda: self.run_without_streaming(messages, overrides, auth_claims)
+        )
+        if shared:
+            metrics.increment("chat_coalesced_requests_total", {"mode": "response"})
+        return self.with_session_state(response, session_state)
 
     def get_messages_from_history(
         self,
@@ -302,14 +959,24 @@ class ChatReadRetrieveReadApproach(Approach):
         message_builder = MessageBuilder(system_prompt, model_id)
 
         message_builder.append_message(self.USER, user_content)
-        total_token_count = message_builder.count_tokens_for_message(message_builder.messages[-1])
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
-            message_builder.append_message(message["role"], message["content"])
-            total_token_count += potential_message_count
-        return message_builder.messages
\ No newline at end of file
+        message_builder.token_count = message_builder.count_tokens_for_message(message_builder.conversation[-1])
+
+        # Earlier turns were counted on previous requests, so this only encodes the newest messages
+        if not message_builder.add_history(history[-2::-1], max_tokens):
+            logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+        span = trace.get_current_span()
+        span.set_attribute("history.tokens", message_builder.token_count)
+        span.set_attribute("history.messages_kept", len(message_builder.conversation))
+        return message_builder.messages
+
+    def report_metrics(self):
+        # Point in time values, refreshed each time /metrics is scraped
+        for name, cache in (("translation", self.translation_cache), ("result", self.result_cache)):
+            stats = cache.stats()
+            metrics.set_gauge("chat_cache_entries", {"cache": name}, stats["size"])
+            metrics.set_gauge("chat_cache_hit_rate", {"cache": name}, stats["hit_rate"])
+        metrics.set_gauge("sql_pool_connections", {"state": "open"}, self.connection_pool.size)
+        metrics.set_gauge("sql_pool_connections", {"state": "idle"}, self.connection_pool.idle_count)
+        metrics.set_gauge("sql_executor_pending", {}, self.query_executor.pending)
+        metrics.set_gauge("chat_coalesced_in_flight", {"mode": "response"}, len(self.request_flights))
+        metrics.set_gauge("chat_coalesced_in_flight", {"mode": "stream"}, len(self.stream_flights))
@@ -0,0 +1,132 @@
+"""
+Fake Azure OpenAI chat completions server for offline benchmarks.
+
+Answers the QueryPlugin prompts without a model: nlpToSql gets a query against the table named in the question
+(see localdb.py), explainSql gets a fixed length explanation, nlpToSqlExplained gets both as a JSON object
+and fixSql gets the nlpToSql query again. All honour a configurable time to first token, and streamed
+responses are sent as server-sent events with a delay between chunks.
+
+Usage (from app/backend):
+    python benchmarks/fake_openai.py --port 8090 --latency 0.4 --chunk-delay 0.02 --explain-words 80
+Then point the app at it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:8090 and any AZURE_OPENAI_API_KEY.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+TABLE_PATTERN = re.compile(r"\btable_\d{3}\b")
+EXPLANATION_WORDS = (
+    "The query groups the rows of the table by region and counts them, which answers the question because "
+    "each region appears once in the result with the number of matching rows next to it."
+).split()
+
+
+def query_text(prompt: str) -> str:
+    # The question is the text after "query to find"
+    question = prompt.rsplit("query to find", 1)[-1]
+    match = TABLE_PATTERN.search(question) or TABLE_PATTERN.search(prompt)
+    table = match.group(0) if match else "table_000"
+    return (
+        "SELECT region, COUNT(*) AS row_count, AVG(metric_00) AS average_metric\n"
+        f"FROM bench.{table}\nGROUP BY region\nORDER BY region"
+    )
+
+
+def completion_text(prompt: str, explain_words: int) -> str:
+    explanation = " ".join(EXPLANATION_WORDS[index % len(EXPLANATION_WORDS)] for index in range(explain_words))
+    if "can't be run because" in prompt:
+        return f"```sql\n{query_text(prompt.rsplit('written to find', 1)[-1])}\n```"
+    if '"explanation"' in prompt:
+        return json.dumps({"sql": query_text(prompt), "explanation": explanation})
+    if "Provide the SQL Server query" in prompt:
+        return f"```sql\n{query_text(prompt)}\n```"
+    return explanation
+
+
+def chunk_event(completion_id: str, model: str, content: str = None, finish_reason: str = None) -> bytes:
+    delta = {"role": "assistant", "content": content} if content is not None else {}
+    event = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}],
+    }
+    return b"data: " + json.dumps(event).encode("utf-8") + b"\n\n"
+
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    settings = request.app["settings"]
+    body = await request.json()
+    prompt = "\n".join(str(message.get("content") or "") for message in body.get("messages", []))
+    text = completion_text(prompt, settings.explain_words)
+    model = request.match_info.get("deployment", body.get("model", "gpt-4o"))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    await asyncio.sleep(settings.latency)
+
+    if not body.get("stream"):
+        words = len(text.split())
+        await asyncio.sleep(settings.chunk_delay * words / settings.words_per_chunk)
+        return web.json_response(
+            {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                        "logprobs": None,
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": len(prompt) // 4,
+                    "completion_tokens": words,
+                    "total_tokens": len(prompt) // 4 + words,
+                },
+            }
+        )
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    words = text.split(" ")
+    for start in range(0, len(words), settings.words_per_chunk):
+        content = " ".join(words[start : start + settings.words_per_chunk])
+        await response.write(chunk_event(completion_id, model, content if start == 0 else " " + content))
+        await asyncio.sleep(settings.chunk_delay)
+    await response.write(chunk_event(completion_id, model, finish_reason="stop"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+def create_app(settings: argparse.Namespace) -> web.Application:
+    app = web.Application()
+    app["settings"] = settings
+    app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.4, help="Seconds before the first token")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="Seconds between streamed chunks")
+    parser.add_argument("--words-per-chunk", type=int, default=3)
+    parser.add_argument("--explain-words", type=int, default=80, help="Length of the explainSql answer")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    web.run_app(create_app(arguments), host=arguments.host, port=arguments.port, print=None)
@@ -0,0 +1,284 @@
+"""
+Offline load test for /chat.
+
+Starts the fake OpenAI server (fake_openai.py) and the app under gunicorn with Uvicorn workers, using the local
+database from localdb.py, then sends /chat requests at each concurrency level. For every level it reports
+throughput, latency percentiles (and time to first event when streaming) and the mean time spent in each
+pipeline stage, read from the workers' /metrics.
+
+Usage (from app/backend):
+    python benchmarks/loadtest.py --concurrency 1 4 16 64 --requests 200 --workers 4
+    python benchmarks/loadtest.py --stream --distinct-questions 20 --openai-latency 0.8
+    python benchmarks/loadtest.py --single-round-trip   # SQL and explanation from one completion
+    python benchmarks/loadtest.py --url http://127.0.0.1:8000 --concurrency 8   # an app that is already running
+
+Use the same flags before and after a change to chatreadretrieveread.py and compare the tables.
+Starting the app needs gunicorn, which the deployed image doesn't use: pip install gunicorn
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import aiohttp
+
+BACKEND_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIRECTORY)
+
+from benchmarks.localdb import create_database, table_name  # noqa: E402
+
+STAGE_PATTERN = re.compile(
+    r'^chat_stage_duration_seconds_(sum|count)\{worker="(?P<worker>[^"]+)",stage="(?P<stage>[^"]+)"\} (?P<value>\S+)$'
+)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def make_question(rng: random.Random, args: argparse.Namespace) -> str:
+    index = rng.randrange(args.distinct_questions)
+    return f"How many rows does each region have in {table_name(index % args.tables)}, case {index}?"
+
+
+async def send_chat(
+    session: aiohttp.ClientSession, url: str, question: str, args: argparse.Namespace
+) -> tuple[float, float]:
+    stream = args.stream
+    body = {
+        "messages": [{"role": "user", "content": question}],
+        "stream": stream,
+        "context": {"overrides": {"top": 10, "single_round_trip": args.single_round_trip}},
+    }
+    start = time.perf_counter()
+    first_event = None
+    async with session.post(f"{url}/chat", json=body) as response:
+        if response.status != 200:
+            raise RuntimeError(f"/chat returned {response.status}: {await response.text()}")
+        if stream:
+            async for line in response.content:
+                if first_event is None and line.strip():
+                    first_event = time.perf_counter() - start
+                if line.strip() and "error" in json.loads(line):
+                    raise RuntimeError(line.decode("utf-8"))
+        else:
+            await response.read()
+    total = time.perf_counter() - start
+    return total, first_event if first_event is not None else total
+
+
+async def scrape_stages(session: aiohttp.ClientSession, url: str, scrapes: int) -> dict[str, dict[str, list[float]]]:
+    # Each scrape reaches one worker, scraping several times collects most of them. Keyed by worker, then stage.
+    workers: dict[str, dict[str, list[float]]] = {}
+    for _ in range(scrapes):
+        try:
+            async with session.get(f"{url}/metrics") as response:
+                text = await response.text()
+        except aiohttp.ClientError:
+            continue
+        for line in text.splitlines():
+            match = STAGE_PATTERN.match(line)
+            if match:
+                stage = workers.setdefault(match["worker"], {}).setdefault(match["stage"], [0.0, 0.0])
+                stage[0 if match.group(1) == "sum" else 1] = float(match["value"])
+    return workers
+
+
+def stage_deltas(before: dict, after: dict) -> dict[str, tuple[float, float]]:
+    totals: dict[str, list[float]] = {}
+    for worker, stages in after.items():
+        for stage, (total, count) in stages.items():
+            previous_total, previous_count = before.get(worker, {}).get(stage, (0.0, 0.0))
+            entry = totals.setdefault(stage, [0.0, 0.0])
+            entry[0] += total - previous_total
+            entry[1] += count - previous_count
+    return {stage: (total, count) for stage, (total, count) in totals.items() if count > 0}
+
+
+async def run_level(url: str, concurrency: int, args: argparse.Namespace, rng: random.Random) -> dict:
+    latencies: list[float] = []
+    first_events: list[float] = []
+    errors = 0
+    remaining = args.requests
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        before = await scrape_stages(session, url, args.scrapes)
+
+        async def client():
+            nonlocal remaining, errors
+            while remaining > 0:
+                remaining -= 1
+                try:
+                    total, first_event = await send_chat(session, url, make_question(rng, args), args)
+                    latencies.append(total)
+                    first_events.append(first_event)
+                except Exception as e:
+                    errors += 1
+                    if errors <= 3:
+                        print(f"  request failed: {e}", file=sys.stderr)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        after = await scrape_stages(session, url, args.scrapes)
+    return {
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latencies": latencies,
+        "first_events": first_events,
+        "stages": stage_deltas(before, after),
+    }
+
+
+def print_level(result: dict, stream: bool):
+    latencies = result["latencies"]
+    print(
+        f"{result['concurrency']:>5} {result['ok']:>6} {result['errors']:>6} {result['throughput']:>8.2f}"
+        f" {percentile(latencies, 0.5) * 1000:>8.0f} {percentile(latencies, 0.9) * 1000:>8.0f}"
+        f" {percentile(latencies, 0.99) * 1000:>8.0f} {max(latencies, default=0) * 1000:>8.0f}"
+        + (f" {percentile(result['first_events'], 0.5) * 1000:>8.0f}" if stream else "")
+    )
+
+
+def print_stages(results: list[dict]):
+    stages = sorted({stage for result in results for stage in result["stages"]})
+    if not stages:
+        print("\nNo stage metrics were collected from /metrics")
+        return
+    print("\nMean stage latency in ms (calls) per concurrency level")
+    print(f"{'stage':<20}" + "".join(f"{result['concurrency']:>16}" for result in results))
+    for stage in stages:
+        cells = []
+        for result in results:
+            total, count = result["stages"].get(stage, (0.0, 0.0))
+            cells.append(f"{total / count * 1000:>9.1f} ({int(count):>4})" if count else f"{'-':>16}")
+        print(f"{stage:<20}" + "".join(cells))
+
+
+def start_process(command: list[str], env: dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(command, cwd=BACKEND_DIRECTORY, env=env, start_new_session=True)
+
+
+def stop_process(process: Optional[subprocess.Popen]):
+    if process is not None and process.poll() is None:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+async def wait_until_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"{url} did not come up within {timeout} seconds")
+
+
+async def main(args: argparse.Namespace):
+    openai_process = app_process = None
+    url = args.url
+    try:
+        if url is None:
+            if args.recreate_db or not os.path.exists(args.db_path):
+                print(f"Creating {args.tables} tables with {args.columns} columns in {args.db_path}")
+                create_database(args.db_path, args.tables, args.columns, args.rows)
+            env = {
+                **os.environ,
+                "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{args.openai_port}",
+                "AZURE_OPENAI_API_KEY": "benchmark",
+                "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "chat",
+                "AZURE_OPENAI_CHATGPT_MODEL": args.model,
+                "DATABASE_CONNECTION_STRING": "Driver=sqlite;Database=bench;",
+                "BENCH_DB_PATH": args.db_path,
+                "BENCH_DB_LATENCY": str(args.db_latency),
+                "APP_LOG_LEVEL": "WARNING",
+            }
+            openai_process = start_process(
+                [
+                    sys.executable, "benchmarks/fake_openai.py", "--port", str(args.openai_port),
+                    "--latency", str(args.openai_latency), "--chunk-delay", str(args.chunk_delay),
+                    "--explain-words", str(args.explain_words),
+                ],
+                env,
+            )
+            app_process = start_process(
+                [
+                    sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{args.port}",
+                    "--workers", str(args.workers), "benchmarks.server:create_app()",
+                ],
+                env,
+            )
+            url = f"http://127.0.0.1:{args.port}"
+        await wait_until_ready(f"{url}/basepath")
+
+        rng = random.Random(args.seed)
+        print(
+            f"\n{args.requests} requests per level, stream={args.stream}, single_round_trip={args.single_round_trip},"
+            f" {args.distinct_questions} distinct questions"
+        )
+        print(
+            f"{'conc':>5} {'ok':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+            + (f" {'ttfe p50':>8}" if args.stream else "")
+        )
+        results = []
+        for concurrency in args.concurrency:
+            result = await run_level(url, concurrency, args, rng)
+            print_level(result, args.stream)
+            results.append(result)
+        print_stages(results)
+    finally:
+        stop_process(app_process)
+        stop_process(openai_process)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Benchmark an app that is already running instead of starting one")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument("--stream", action="store_true", help="Request NDJSON streaming responses")
+    parser.add_argument("--single-round-trip", action="store_true", help="Ask for the SQL and explanation together")
+    parser.add_argument("--distinct-questions", type=int, default=100000, help="Lower it to exercise the caches")
+    parser.add_argument("--timeout", type=float, default=240)
+    parser.add_argument("--scrapes", type=int, default=20, help="/metrics reads per level, to reach every worker")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--openai-port", type=int, default=8090)
+    parser.add_argument("--openai-latency", type=float, default=0.4)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--explain-words", type=int, default=80)
+    parser.add_argument("--db-path", default="/tmp/data-chat-bench.db")
+    parser.add_argument("--db-latency", type=float, default=0.005)
+    parser.add_argument("--recreate-db", action="store_true")
+    parser.add_argument("--tables", type=int, default=300)
+    parser.add_argument("--columns", type=int, default=40)
+    parser.add_argument("--rows", type=int, default=2000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,155 @@
+"""
+Local stand-in for Azure SQL, used by the load test.
+
+A SQLite file is attached as the "bench" schema and seeded with many wide tables, so table ranking, prompt size
+and result rendering behave like a large warehouse. LocalApproach is ChatReadRetrieveReadApproach with its
+connections, schema queries and plan guard pointed at that file. SQL Server session statements (SET ...) are
+accepted and ignored.
+
+Usage (from app/backend), to create or recreate the database on its own:
+    python benchmarks/localdb.py --path /tmp/data-chat-bench.db --tables 300 --columns 40 --rows 2000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from typing import Any, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach  # noqa: E402
+
+SCHEMA_NAME = "bench"
+REGIONS = ("north", "south", "east", "west", "central")
+
+
+def table_name(index: int) -> str:
+    return f"table_{index:03d}"
+
+
+def create_database(path: str, tables: int = 300, columns: int = 40, rows: int = 2000, seed: int = 7):
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    try:
+        for index in range(tables):
+            value_columns = [f"metric_{column:02d}" for column in range(columns)]
+            conn.execute(
+                f"CREATE TABLE {table_name(index)} (id INTEGER PRIMARY KEY, customer_id INTEGER, region TEXT, "
+                "created_at TEXT, " + ", ".join(f"{column} REAL" for column in value_columns) + ")"
+            )
+            conn.executemany(
+                f"INSERT INTO {table_name(index)} VALUES ({', '.join('?' * (columns + 4))})",
+                (
+                    (row, rng.randrange(10000), rng.choice(REGIONS), f"2024-{1 + row % 12:02d}-{1 + row % 28:02d}",
+                     *(round(rng.random() * 1000, 2) for _ in value_columns))
+                    for row in range(rows)
+                ),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class LocalCursor:
+    def __init__(self, cursor: sqlite3.Cursor, latency: float):
+        self.cursor = cursor
+        self.latency = latency
+        self.description: Optional[tuple] = None
+
+    def execute(self, statement: str):
+        if statement.lstrip().upper().startswith("SET "):
+            return self
+        if self.latency:
+            # Network round trip to the database
+            time.sleep(self.latency)
+        self.cursor.execute(statement)
+        self.description = self.cursor.description
+        return self
+
+    def fetchone(self) -> Any:
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size: int) -> list:
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self) -> list:
+        return self.cursor.fetchall()
+
+    def nextset(self) -> bool:
+        return False
+
+    def close(self):
+        self.cursor.close()
+
+
+class LocalConnection:
+    def __init__(self, path: str, latency: float):
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.conn.execute(f"ATTACH DATABASE ? AS {SCHEMA_NAME}", (path,))
+        self.latency = latency
+        self.timeout = 0
+
+    def cursor(self) -> LocalCursor:
+        return LocalCursor(self.conn.cursor(), self.latency)
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class LocalApproach(ChatReadRetrieveReadApproach):
+    """
+    Reads BENCH_DB_PATH (default /tmp/data-chat-bench.db) and BENCH_DB_LATENCY (seconds added to every statement).
+    """
+
+    schema_query = f"""
+        SELECT '{SCHEMA_NAME}.' || m.name || ' (' || group_concat(p.name, ', ') || ')'
+        FROM {SCHEMA_NAME}.sqlite_master AS m, pragma_table_info(m.name, '{SCHEMA_NAME}') AS p
+        WHERE m.type = 'table'
+        GROUP BY m.name
+    """
+
+    schema_objects_query = f"""
+        SELECT '{SCHEMA_NAME}.' || m.name || ' (' || group_concat(p.name, ', ') || ')'
+        FROM {SCHEMA_NAME}.sqlite_master AS m, pragma_table_info(m.name, '{SCHEMA_NAME}') AS p
+        WHERE m.type = 'view'
+        GROUP BY m.name
+    """
+
+    schema_version_query = f"SELECT count(*) FROM {SCHEMA_NAME}.sqlite_master"
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        # SQLite has no estimated plans, only the row cap and timeout parts of the guard apply
+        kwargs["query_max_cost"] = 0
+        super().__init__(*args, **kwargs)
+        self.database_path = os.getenv("BENCH_DB_PATH", "/tmp/data-chat-bench.db")
+        self.database_latency = float(os.getenv("BENCH_DB_LATENCY", "0"))
+
+    def get_conn(self) -> LocalConnection:
+        return LocalConnection(self.database_path, self.database_latency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="/tmp/data-chat-bench.db")
+    parser.add_argument("--tables", type=int, default=300)
+    parser.add_argument("--columns", type=int, default=40)
+    parser.add_argument("--rows", type=int, default=2000)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    create_database(args.path, args.tables, args.columns, args.rows)
+    print(f"Created {args.tables} tables in {args.path} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
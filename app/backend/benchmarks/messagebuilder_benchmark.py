@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for history assembly in MessageBuilder.
+
+Simulates a conversation that grows by one question and answer per turn and, on every turn, rebuilds the prompt
+messages the way ChatReadRetrieveReadApproach.get_messages_from_history does. The original list.insert based
+implementation is kept here as a baseline.
+
+Usage (from app/backend):
+    python benchmarks/messagebuilder_benchmark.py --turns 100 300 600 --max-tokens 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tiktoken  # noqa: E402
+
+from core.messagebuilder import MessageBuilder  # noqa: E402
+from core.modelhelper import get_oai_chatmodel_tiktok  # noqa: E402
+
+
+def legacy_messages_from_history(model: str, history: list[dict[str, str]], max_tokens: int) -> list:
+    def count(message):
+        encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+        return 2 + sum(len(encoding.encode(value)) for value in message.values())
+
+    messages = [{"role": "system", "content": unicodedata.normalize("NFC", "None")}]
+    messages.insert(1, {"role": "user", "content": unicodedata.normalize("NFC", history[-1]["content"])})
+    total_token_count = count(messages[-1])
+    for message in list(reversed(history[:-1])):
+        potential_message_count = count(message)
+        if total_token_count + potential_message_count > max_tokens:
+            break
+        messages.insert(1, {"role": message["role"], "content": unicodedata.normalize("NFC", message["content"])})
+        total_token_count += potential_message_count
+    return messages
+
+
+def messages_from_history(model: str, history: list[dict[str, str]], max_tokens: int) -> list:
+    message_builder = MessageBuilder("None", model)
+    message_builder.append_message("user", history[-1]["content"])
+    message_builder.token_count = message_builder.count_tokens_for_message(message_builder.conversation[-1])
+    message_builder.add_history(history[-2::-1], max_tokens)
+    return message_builder.messages
+
+
+def make_turn(index: int) -> list[dict[str, str]]:
+    question = f"How many orders did customer {index} place in région {index % 7} during 2023?"
+    answer = (
+        f"The query counts rows in Sales.Orders for CustomerID {index}.\n"
+        "```sql\nSELECT COUNT(*) FROM Sales.Orders WHERE CustomerID = " + str(index) + "\n```\n"
+        "### Results Returned\n| count | \n| --- | \n| " + str(index * 3) + " | \n"
+    )
+    return [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+
+def run_conversation(build, model: str, turns: int, max_tokens: int) -> list[float]:
+    history: list[dict[str, str]] = []
+    timings = []
+    for turn in range(turns):
+        history.extend(make_turn(turn))
+        # The latest user question is the last message, as in a /chat request
+        request_history = history[:-1]
+        start = time.perf_counter()
+        build(model, request_history, max_tokens)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--turns", type=int, nargs="+", default=[100, 300, 600])
+    parser.add_argument("--max-tokens", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'turns':>6} {'impl':>8} {'total ms':>10} {'last turn ms':>13}")
+    for turns in args.turns:
+        for name, build in (("legacy", legacy_messages_from_history), ("current", messages_from_history)):
+            timings = run_conversation(build, args.model, turns, args.max_tokens)
+            print(f"{turns:>6} {name:>8} {sum(timings) * 1000:>10.1f} {timings[-1] * 1000:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+"""
+App factory for benchmarks: the real create_app(), with the chat approach reading from the local database in
+localdb.py. Everything else (routes, caches, pools, executor, streaming) is the production code path.
+
+Usage (from app/backend):
+    gunicorn -c gunicorn.conf.py --bind 127.0.0.1:8000 --workers 4 "benchmarks.server:create_app()"
+"""
+
+import app
+from benchmarks.localdb import LocalApproach
+
+
+def create_app():
+    # setup_clients looks the class up on the app module when the worker starts serving
+    app.ChatReadRetrieveReadApproach = LocalApproach
+    return app.create_app()
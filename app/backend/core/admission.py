@@ -0,0 +1,134 @@
+import asyncio
+import contextlib
+import math
+import time
+from collections import deque
+from typing import Callable, Optional
+
+from .metrics import metrics
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits how many requests run at once in this worker, overall and per user, so bursts are turned away
+    early with a retry hint instead of piling up until the server timeout.
+    Attributes:
+        max_in_flight (int): Requests allowed to run at the same time.
+        max_per_user (int): Requests one user may have running or waiting at the same time.
+        max_queue (int): Requests allowed to wait for a slot, more are rejected right away.
+        max_wait (float): Longest a request may wait for a slot. Requests whose estimated wait is longer
+            are rejected without waiting.
+        average_duration (float): Moving average of how long admitted requests hold their slot.
+    Methods:
+        acquire(self, user): Waits for a slot and returns the function that gives it back.
+    """
+
+    default_retry_after = 5
+
+    def __init__(self, max_in_flight: int = 32, max_per_user: int = 4, max_queue: int = 64, max_wait: float = 30):
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.average_duration: Optional[float] = None
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self._per_user: dict[str, int] = {}
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def estimate_wait(self, position: int) -> Optional[float]:
+        if self.average_duration is None:
+            return None
+        return position / self.max_in_flight * self.average_duration
+
+    async def acquire(self, user: Optional[str]) -> Callable[[], None]:
+        if user is not None and self._per_user.get(user, 0) >= self.max_per_user:
+            self._reject("per_user", f"Too many requests in progress for this user, at most {self.max_per_user}")
+        has_slot = self.in_flight < self.max_in_flight and not self._waiters
+        if not has_slot:
+            if len(self._waiters) >= self.max_queue:
+                self._reject("queue_full", "The server is busy, try again shortly")
+            estimated_wait = self.estimate_wait(len(self._waiters) + 1)
+            if estimated_wait is not None and estimated_wait > self.max_wait:
+                # Waiting would most likely end in a timeout, say so now
+                self._reject("deadline", "The server is busy, try again shortly", estimated_wait)
+        # Waiting requests count against the user's limit too
+        self._add_user(user)
+        if has_slot:
+            self.in_flight += 1
+        else:
+            try:
+                await self._wait_for_slot()
+            except BaseException:
+                self._remove_user(user)
+                raise
+        return self._releaser(user, time.monotonic())
+
+    def _add_user(self, user: Optional[str]):
+        if user is not None:
+            self._per_user[user] = self._per_user.get(user, 0) + 1
+
+    def _remove_user(self, user: Optional[str]):
+        if user is not None:
+            remaining = self._per_user.get(user, 1) - 1
+            if remaining:
+                self._per_user[user] = remaining
+            else:
+                self._per_user.pop(user, None)
+
+    async def _wait_for_slot(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the wait ended, pass it on
+                self._release_slot()
+            else:
+                with contextlib.suppress(ValueError):
+                    self._waiters.remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("timeout", "The server is busy, try again shortly")
+            raise
+
+    def _releaser(self, user: Optional[str], started_at: float) -> Callable[[], None]:
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            duration = time.monotonic() - started_at
+            self.average_duration = (
+                duration if self.average_duration is None else 0.8 * self.average_duration + 0.2 * duration
+            )
+            self._remove_user(user)
+            self._release_slot()
+
+        return release
+
+    def _release_slot(self):
+        # Hand the slot straight to the oldest waiter, so newcomers can't overtake the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def _reject(self, reason: str, message: str, estimated_wait: Optional[float] = None):
+        metrics.increment("chat_admission_rejections_total", {"reason": reason})
+        wait = estimated_wait if estimated_wait is not None else self.estimate_wait(len(self._waiters) + 1)
+        retry_after = math.ceil(wait) if wait is not None else self.default_retry_after
+        raise AdmissionRejectedError(message, max(1, retry_after))
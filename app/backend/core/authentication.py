@@ -1,8 +1,12 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import base64
+import hashlib
 import json
 import logging
 import os
+import time
 from tempfile import TemporaryDirectory
 from typing import Any, Optional
 
@@ -14,6 +18,8 @@ from msal_extensions import (
     build_encrypted_persistence,
 )
 
+from .cache import LRUCache
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -24,6 +30,8 @@ class AuthError(Exception):
 
 class AuthenticationHelper:
     scope: str = "https://graph.microsoft.com/.default"
+    graph_connection_limit: int = 20
+    graph_timeout: float = 30
 
     def __init__(
         self,
@@ -33,6 +41,10 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         token_cache_path: Optional[str] = None,
+        claims_cache_size: int = 1024,
+        groups_cache_size: int = 1024,
+        groups_cache_ttl: float = 3600,
+        groups_refresh_interval: float = 300,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -40,6 +52,16 @@ class AuthenticationHelper:
         self.client_app_id = client_app_id
         self.tenant_id = tenant_id
         self.authority = f"https://login.microsoftonline.com/{tenant_id}"
+        # Result of the On Behalf Of exchange keyed by a hash of the incoming token, each entry expires with its token.
+        # Groups read from Graph aren't kept here, they are looked up in groups_cache on every request
+        self.claims_cache = LRUCache(maxsize=claims_cache_size)
+        self._pending_claims: dict[str, asyncio.Task] = {}
+        # Group membership keyed by oid. Entries older than groups_refresh_interval are still served
+        # while a background task reads them again from Microsoft Graph
+        self.groups_cache = LRUCache(maxsize=groups_cache_size, ttl=groups_cache_ttl)
+        self.groups_refresh_interval = groups_refresh_interval
+        self._pending_groups: dict[str, asyncio.Task] = {}
+        self._graph_session: Optional[aiohttp.ClientSession] = None
 
         if self.use_authentication:
             self.token_cache_path = token_cache_path
@@ -142,67 +164,99 @@ class AuthenticationHelper:
         else:
             return None
 
-    @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    def get_graph_session(self) -> aiohttp.ClientSession:
+        # One session for the life of the app so Graph connections and TLS handshakes are reused across requests.
+        # Created lazily because a session must be created inside the running event loop.
+        if self._graph_session is None or self._graph_session.closed:
+            self._graph_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.graph_connection_limit, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.graph_timeout),
+            )
+        return self._graph_session
+
+    async def close(self):
+        for task in list(self._pending_groups.values()):
+            task.cancel()
+        if self._graph_session is not None:
+            await self._graph_session.close()
+
+    async def list_groups(self, graph_resource_access_token: dict) -> list[str]:
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            resp_json = None
-            resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
+        session = self.get_graph_session()
+        # The pages can only be read one after another, so ask for the largest page size Graph allows
+        next_link = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"
+        while next_link:
+            async with session.get(url=next_link, headers=headers) as resp:
                 resp_json = await resp.json()
-                resp_status = resp.status
-                if resp_status != 200:
-                    raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
-
-            while resp_status == 200:
-                value = resp_json["value"]
-                for group in value:
-                    groups.append(group["id"])
-                next_link = resp_json.get("@odata.nextLink")
-                if next_link:
-                    async with session.get(url=next_link) as resp:
-                        resp_json = await resp.json()
-                        resp_status = resp.status
-                else:
-                    break
-            if resp_status != 200:
-                raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
+                if resp.status != 200:
+                    raise AuthError(error=json.dumps(resp_json), status_code=resp.status)
+            groups.extend(group["id"] for group in resp_json["value"])
+            next_link = resp_json.get("@odata.nextLink")
+
+        return groups
+
+    async def get_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        entry = self.groups_cache.get(oid)
+        if entry is None:
+            # Nothing cached for this user yet, so this request waits on Graph
+            return await asyncio.shield(self._start_groups_refresh(oid, graph_resource_access_token))
+        if time.monotonic() - entry["fetched_at"] >= self.groups_refresh_interval:
+            self._start_groups_refresh(oid, graph_resource_access_token)
+        return entry["groups"]
+
+    def _start_groups_refresh(self, oid: str, graph_resource_access_token: dict) -> asyncio.Task:
+        refresh = self._pending_groups.get(oid)
+        if refresh is None:
+            refresh = asyncio.create_task(self._refresh_groups(oid, graph_resource_access_token))
+            self._pending_groups[oid] = refresh
+            refresh.add_done_callback(self._groups_refresh_done(oid))
+        return refresh
 
+    async def _refresh_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        groups = await self.list_groups(graph_resource_access_token)
+        self.groups_cache.set(oid, {"groups": groups, "fetched_at": time.monotonic()})
         return groups
 
+    def _groups_refresh_done(self, oid: str):
+        def done(task: asyncio.Task):
+            self._pending_groups.pop(oid, None)
+            if not task.cancelled() and task.exception() is not None:
+                logging.warning("Refreshing groups for %s failed", oid, exc_info=task.exception())
+
+        return done
+
+    @staticmethod
+    def get_token_expiry(auth_token: str) -> Optional[float]:
+        # Reads the exp claim of the incoming token. The signature was already checked by the On Behalf Of exchange,
+        # the expiry is only used to decide how long the exchanged claims may be reused.
+        try:
+            payload = auth_token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims["exp"])
+        except Exception:
+            return None
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
         try:
-            # Read the authentication token from the authorization header and exchange it using the On Behalf Of Flow
-            # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
-            # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
-            )
-            if "error" in graph_resource_access_token:
-                raise AuthError(error=str(graph_resource_access_token), status_code=401)
-
-            # Read the claims from the response. The oid and groups claims are used for security filtering
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
-            id_token_claims = graph_resource_access_token["id_token_claims"]
-            auth_claims = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups") or []}
-
-            # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
-            # or a groups overage claim may have been emitted.
-            # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
-            missing_groups_claim = "groups" not in id_token_claims
-            has_group_overage_claim = (
-                missing_groups_claim
-                and "_claim_names" in id_token_claims
-                and "groups" in id_token_claims["_claim_names"]
-            )
-            if missing_groups_claim or has_group_overage_claim:
-                # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
-            return auth_claims
+            token_key = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            exchanged = self.claims_cache.get(token_key)
+            if exchanged is None:
+                # Concurrent requests with the same token share a single exchange
+                exchange = self._pending_claims.get(token_key)
+                if exchange is None:
+                    exchange = asyncio.create_task(self.exchange_auth_claims(auth_token, token_key))
+                    self._pending_claims[token_key] = exchange
+                    exchange.add_done_callback(lambda _: self._pending_claims.pop(token_key, None))
+                exchanged = await asyncio.shield(exchange)
+            if exchanged["graph_token"] is None:
+                return {"oid": exchanged["oid"], "groups": exchanged["groups"]}
+            # Read the user's groups from Microsoft Graph, through the cache so its TTL and refresh apply
+            groups = await self.get_groups(exchanged["oid"], exchanged["graph_token"])
+            return {"oid": exchanged["oid"], "groups": groups}
         except AuthError as e:
             print(e.error)
             logging.exception("Exception getting authorization information - " + json.dumps(e.error))
@@ -210,3 +264,45 @@ class AuthenticationHelper:
         except Exception:
             logging.exception("Exception getting authorization information")
             return {}
+
+    async def exchange_auth_claims(self, auth_token: str, token_key: str) -> dict[str, Any]:
+        # Exchange the authentication token using the On Behalf Of Flow
+        # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
+        # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
+        # MSAL is synchronous, so the exchange runs in a worker thread instead of blocking the event loop
+        # Returns the oid and either the groups claim or the Graph token their overage is read with
+        graph_resource_access_token = await asyncio.to_thread(
+            self.confidential_client.acquire_token_on_behalf_of, user_assertion=auth_token, scopes=[self.scope]
+        )
+        if "error" in graph_resource_access_token:
+            raise AuthError(error=str(graph_resource_access_token), status_code=401)
+
+        # Read the claims from the response. The oid and groups claims are used for security filtering
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference
+        id_token_claims = graph_resource_access_token["id_token_claims"]
+        exchanged = {"oid": id_token_claims["oid"], "groups": id_token_claims.get("groups") or [], "graph_token": None}
+
+        # A groups claim may have been omitted either because it was not added in the application manifest for the API application,
+        # or a groups overage claim may have been emitted.
+        # https://learn.microsoft.com/azure/active-directory/develop/id-token-claims-reference#groups-overage-claim
+        missing_groups_claim = "groups" not in id_token_claims
+        has_group_overage_claim = (
+            missing_groups_claim
+            and "_claim_names" in id_token_claims
+            and "groups" in id_token_claims["_claim_names"]
+        )
+        graph_token_ttl = float(graph_resource_access_token.get("expires_in") or 0)
+        if missing_groups_claim or has_group_overage_claim:
+            # The groups are read from Microsoft Graph per request, keep only the token needed to do so
+            exchanged["groups"] = None
+            exchanged["graph_token"] = {"access_token": graph_resource_access_token["access_token"]}
+
+        # Keep the exchange until the incoming token expires, falling back to the lifetime of the exchanged token.
+        # When the Graph token is kept it must still be valid for the whole time.
+        expires_at = AuthenticationHelper.get_token_expiry(auth_token)
+        ttl = expires_at - time.time() if expires_at else graph_token_ttl
+        if exchanged["graph_token"] is not None:
+            ttl = min(ttl, graph_token_ttl)
+        if ttl > 0:
+            self.claims_cache.set(token_key, exchanged, ttl)
+        return exchanged
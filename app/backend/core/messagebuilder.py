@@ -1,29 +1,61 @@
 import unicodedata
+from collections import deque
+from typing import Iterable
 
-from .modelhelper import num_tokens_from_messages
+from .modelhelper import num_tokens_from_messages, num_tokens_from_messages_batch
 
 
 class MessageBuilder:
     """
     A class for building and managing messages in a chat conversation.
     Attributes:
-        message (list): A list of dictionaries representing chat messages.
+        messages (list): A list of dictionaries representing chat messages, system message first.
         model (str): The name of the ChatGPT model.
-        token_count (int): The total number of tokens in the conversation.
+        token_count (int): The total number of tokens of the messages added through add_history.
     Methods:
         __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
         append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+        add_history(self, newest_to_oldest, max_tokens: int): Prepends history messages until the token budget is used.
     """
 
     def __init__(self, system_content: str, chatgpt_model: str):
-        self.messages = [{"role": "system", "content": self.normalize_content(system_content)}]
+        self.system_message = {"role": "system", "content": self.normalize_content(system_content)}
+        # Everything after the system message. History is added newest first, so it is prepended,
+        # which a deque does in constant time where list.insert(1, ...) shifts the whole list.
+        self.conversation: deque[dict[str, str]] = deque()
         self.model = chatgpt_model
+        self.token_count = 0
+
+    @property
+    def messages(self) -> list[dict[str, str]]:
+        return [self.system_message, *self.conversation]
 
     def append_message(self, role: str, content: str, index: int = 1):
-        self.messages.insert(index, {"role": role, "content": self.normalize_content(content)})
+        message = {"role": role, "content": self.normalize_content(content)}
+        if index <= 1:
+            self.conversation.appendleft(message)
+        else:
+            self.conversation.insert(index - 1, message)
+
+    def add_history(self, newest_to_oldest: Iterable[dict[str, str]], max_tokens: int) -> bool:
+        """
+        Adds past messages, newest first, right after the system message until the next one would take
+        token_count over max_tokens. All counts come from one batch call. Returns False if history was truncated.
+        """
+        history = list(newest_to_oldest)
+        token_counts = num_tokens_from_messages_batch(history, self.model)
+        for message, message_token_count in zip(history, token_counts):
+            if self.token_count + message_token_count > max_tokens:
+                return False
+            self.append_message(message["role"], message["content"])
+            self.token_count += message_token_count
+        return True
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
     def normalize_content(self, content: str):
+        # Most content is ASCII or already NFC, checking is much cheaper than normalizing again every turn
+        if content.isascii() or unicodedata.is_normalized("NFC", content):
+            return content
         return unicodedata.normalize("NFC", content)
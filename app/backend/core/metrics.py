@@ -0,0 +1,120 @@
+import bisect
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Iterator
+
+from opentelemetry import trace
+
+tracer = trace.get_tracer("data-chat")
+
+# Upper bounds in seconds, from a fast cache lookup to a slow completion or query
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class LatencyHistogram:
+    """
+    A cumulative histogram in the Prometheus layout. Observations may come from the event loop and from
+    database threads, so updates take a lock.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Metrics:
+    """
+    Per-process stage latencies, counters and gauges, rendered in the Prometheus text format by the /metrics route.
+    Each gunicorn worker keeps its own numbers, so every series carries a worker label.
+    Methods:
+        stage(self, name, attach=True, **attributes): Context manager that opens a span for the stage and records its latency.
+        observe(self, stage, seconds): Records a stage latency measured elsewhere.
+        increment(self, name, labels, value=1): Adds to a counter.
+        set_gauge(self, name, labels, value): Sets a gauge.
+        render(self): Returns every metric in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.worker = str(os.getpid())
+        self.stages: dict[str, LatencyHistogram] = {}
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, attach: bool = True, **attributes: Any) -> Iterator[trace.Span]:
+        # Async generators resume in other contexts, so inside them pass attach=False to keep the span off the context
+        start = time.perf_counter()
+        if attach:
+            span_context = tracer.start_as_current_span(f"chat.{name}", attributes=attributes)
+        else:
+            span_context = tracer.start_span(f"chat.{name}", attributes=attributes)
+        with span_context as span:
+            try:
+                yield span
+            finally:
+                self.observe(name, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.stages.setdefault(stage, LatencyHistogram())
+        histogram.observe(seconds)
+
+    def increment(self, name: str, labels: dict[str, str], value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, labels: dict[str, str], value: float):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self) -> str:
+        lines = [
+            "# HELP chat_stage_duration_seconds Latency of each /chat pipeline stage.",
+            "# TYPE chat_stage_duration_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.stages.items()):
+            counts, total, count = histogram.snapshot()
+            labels = f'worker="{self.worker}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip((*histogram.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                lines.append(f'chat_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"chat_stage_duration_seconds_sum{{{labels}}} {total}")
+            lines.append(f"chat_stage_duration_seconds_count{{{labels}}} {count}")
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+        lines.extend(self._render_series(counters, "counter"))
+        lines.extend(self._render_series(gauges, "gauge"))
+        return "\n".join(lines) + "\n"
+
+    def _render_series(self, series: list[tuple[tuple[str, tuple], float]], kind: str) -> Iterator[str]:
+        declared = set()
+        for (name, labels), value in series:
+            if name not in declared:
+                declared.add(name)
+                yield f"# TYPE {name} {kind}"
+            label_text = ",".join(f'{key}="{label_value}"' for key, label_value in (("worker", self.worker), *labels))
+            yield f"{name}{{{label_text}}} {value}"
+
+
+metrics = Metrics()
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
-import tiktoken
+import functools
 import re
 
+import tiktoken
+
+from .cache import LRUCache
+
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
     "gpt-3.5-turbo": 4000,
@@ -13,19 +17,59 @@ MODELS_2_TOKEN_LIMITS = {
     "gpt-4o": 16000
 }
 
+# Share of the prompt budget (context window minus response) that table descriptions may use
+SCHEMA_TOKEN_SHARE = 0.5
+
 AOAI_2_OAI = {"gpt-35-turbo": "gpt-3.5-turbo", "gpt-35-turbo-16k": "gpt-3.5-turbo-16k"}
 
+# Token counts keyed by encoding and content, so history that is resent every turn is only encoded once.
+# The dict lookup hashes the content (str caches its hash) and compares on collision, so counts are exact.
+TOKEN_COUNT_CACHE = LRUCache(maxsize=8192, ttl=float("inf"))
+
 
 def get_token_limit(model_id: str) -> int:
     if model_id not in MODELS_2_TOKEN_LIMITS:
         raise ValueError("Expected model gpt-35-turbo and above")
     return MODELS_2_TOKEN_LIMITS[model_id]
 
+def get_schema_token_limit(model_id: str, response_token_limit: int) -> int:
+    return int((get_token_limit(model_id) - response_token_limit) * SCHEMA_TOKEN_SHARE)
+
 def get_database_name(connection_string: str) -> str:
     regex = re.compile(r"Database=(.*?);", re.DOTALL)
     database_name = re.search(regex, connection_string).group(1)
     return database_name
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
+def _token_count_key(encoding: tiktoken.Encoding, text: str) -> tuple:
+    return (encoding.name, text)
+
+
+def num_tokens_from_strings(texts: list[str], model: str) -> list[int]:
+    """
+    Count the tokens of several strings at once. Strings counted before are answered from the memo,
+    the rest are encoded in a single batch.
+    """
+    encoding = get_encoding(model)
+    keys = [_token_count_key(encoding, text) for text in texts]
+    counts = [TOKEN_COUNT_CACHE.get(key) for key in keys]
+    missing = [index for index, count in enumerate(counts) if count is None]
+    if missing:
+        encoded = encoding.encode_batch([texts[index] for index in missing])
+        for index, tokens in zip(missing, encoded):
+            counts[index] = len(tokens)
+            TOKEN_COUNT_CACHE.set(keys[index], counts[index])
+    return counts
+
+
+def num_tokens_from_string(text: str, model: str) -> int:
+    return num_tokens_from_strings([text], model)[0]
+
+
 def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
     """
     Calculate the number of tokens required to encode a message.
@@ -40,11 +84,17 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
-    num_tokens = 2  # For "role" and "content" keys
-    for key, value in message.items():
-        num_tokens += len(encoding.encode(value))
-    return num_tokens
+    return num_tokens_from_messages_batch([message], model)[0]
+
+
+def num_tokens_from_messages_batch(messages: list[dict[str, str]], model: str) -> list[int]:
+    """
+    Calculate the number of tokens of each message, encoding only the contents that haven't been counted before.
+    """
+    values = [value for message in messages for value in message.values()]
+    value_counts = iter(num_tokens_from_strings(values, model))
+    # 2 for the "role" and "content" keys
+    return [2 + sum(next(value_counts) for _ in message) for message in messages]
 
 
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
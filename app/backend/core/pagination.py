@@ -0,0 +1,109 @@
+import base64
+import hashlib
+import hmac
+import json
+import re
+import time
+from typing import Any, Optional
+
+from .resultformat import fetch_rows
+
+
+class InvalidContinuationError(Exception):
+    pass
+
+
+# Literals, quoted identifiers and comments are matched first so keywords inside them are ignored
+SQL_TOKEN_PATTERN = re.compile(
+    r"'(?:[^']|'')*'|\[[^\]]*\]|\"[^\"]*\"|--[^\n]*|/\*.*?\*/|[()]|;|\b(?:ORDER\s+BY|TOP|OFFSET|FOR|OPTION)\b",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def paged_sql(sql_query: str, offset: int, page_size: int) -> Optional[str]:
+    """
+    Adds OFFSET/FETCH to a single statement whose outermost query has an ORDER BY, so the server only returns
+    the requested page (plus one row to tell whether there are more). The clause goes before a top level OPTION
+    clause, which has to stay last. Returns None when the statement can't be paged that way: no top level
+    ORDER BY, a top level TOP, OFFSET or FOR clause, or more than one statement.
+    """
+    sql_query = sql_query.strip().rstrip(";").strip()
+    depth = 0
+    ordered = False
+    option_start = None
+    for match in SQL_TOKEN_PATTERN.finditer(sql_query):
+        token = match.group(0).upper()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and token == ";":
+            return None
+        elif depth == 0 and token.startswith("ORDER"):
+            ordered = True
+        elif depth == 0 and token == "OPTION" and option_start is None:
+            option_start = match.start()
+        elif depth == 0 and token in ("TOP", "OFFSET", "FOR"):
+            return None
+    if not ordered or depth != 0:
+        return None
+    paging = f"OFFSET {offset} ROWS FETCH NEXT {page_size + 1} ROWS ONLY"
+    if option_start is not None:
+        return f"{sql_query[:option_start].rstrip()}\n{paging}\n{sql_query[option_start:]}"
+    return f"{sql_query}\n{paging}"
+
+
+def skip_rows(cursor: Any, count: int, batch_size: int = 1000) -> int:
+    """
+    Reads and discards up to count rows, for statements that can't be paged on the server. Returns the rows skipped.
+    """
+    skipped = 0
+    while skipped < count:
+        batch = cursor.fetchmany(min(batch_size, count - skipped))
+        if not batch:
+            break
+        skipped += len(batch)
+    return skipped
+
+
+def fetch_page(cursor: Any, offset: int, page_size: int, server_paged: bool) -> tuple[list, bool]:
+    if not server_paged:
+        skip_rows(cursor, offset)
+    return fetch_rows(cursor, page_size)
+
+
+def encode_continuation(continuation: dict[str, Any], key: bytes, ttl: float) -> str:
+    """
+    Packs what the next page needs into a token signed with key, so any worker holding the same key can serve it.
+    The token expires after ttl seconds.
+    """
+    payload = json.dumps({**continuation, "expires": time.time() + ttl}, separators=(",", ":")).encode("utf-8")
+    signature = hmac.new(key, payload, hashlib.sha256).digest()
+    return f"{_b64encode(payload)}.{_b64encode(signature)}"
+
+
+def decode_continuation(continuation_token: str, key: bytes) -> dict[str, Any]:
+    """
+    Returns the continuation packed by encode_continuation. Raises InvalidContinuationError when the token is
+    malformed, was not signed with key or has expired.
+    """
+    try:
+        encoded_payload, encoded_signature = continuation_token.split(".")
+        payload = _b64decode(encoded_payload)
+        signature = _b64decode(encoded_signature)
+    except (AttributeError, ValueError):
+        raise InvalidContinuationError("The continuation token is malformed")
+    if not hmac.compare_digest(signature, hmac.new(key, payload, hashlib.sha256).digest()):
+        raise InvalidContinuationError("The continuation token is invalid")
+    continuation = json.loads(payload)
+    if continuation.pop("expires") < time.time():
+        raise InvalidContinuationError("The continuation token has expired")
+    return continuation
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
@@ -0,0 +1,119 @@
+import base64
+import datetime
+import decimal
+import uuid
+from typing import Any, Iterable, Iterator, Sequence
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:  # Arrow output is optional, columnar JSON is used without it
+    pyarrow = None
+
+RESULT_FORMATS = ("markdown", "columnar", "arrow")
+
+# Python types pyodbc reports in cursor.description, mapped to the type names sent to clients
+COLUMN_TYPES = {
+    bool: "boolean",
+    int: "integer",
+    float: "float",
+    decimal.Decimal: "decimal",
+    str: "string",
+    datetime.datetime: "datetime",
+    datetime.date: "date",
+    datetime.time: "time",
+    bytes: "binary",
+    bytearray: "binary",
+    uuid.UUID: "uuid",
+}
+
+
+def fetch_rows(cursor: Any, row_limit: int, batch_size: int = 100) -> tuple[list, bool]:
+    """
+    Fetches at most row_limit rows in fetchmany batches and reports whether more rows were available.
+    When the limit is hit the statement is cancelled, so the server stops sending the rest of the result set.
+    """
+    rows: list = []
+    # One extra row tells us whether the result was truncated
+    wanted = row_limit + 1
+    while len(rows) < wanted:
+        batch = cursor.fetchmany(min(batch_size, wanted - len(rows)))
+        if not batch:
+            break
+        rows.extend(batch)
+    has_more = len(rows) > row_limit
+    if has_more:
+        del rows[row_limit:]
+        cancel = getattr(cursor, "cancel", None)
+        if cancel is not None:
+            cancel()
+    return rows, has_more
+
+
+def markdown_table_lines(columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> Iterator[str]:
+    yield "| " + "".join(f"{column} | " for column in columns) + "\n"
+    yield "| " + "--- | " * len(columns) + "\n"
+    for row in rows:
+        yield "| " + "".join(f"{value} | " for value in row) + "\n"
+
+
+def render_markdown_table(columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> str:
+    return "".join(markdown_table_lines(columns, rows))
+
+
+def render_scalar(rows: Iterable[Sequence[Any]]) -> str:
+    return "".join(str(value) for row in rows for value in row)
+
+
+def column_metadata(description: Sequence[Sequence[Any]]) -> list[dict[str, Any]]:
+    return [
+        {"name": column[0], "type": COLUMN_TYPES.get(column[1], "string"), "nullable": bool(column[6])}
+        for column in description
+    ]
+
+
+def json_value(value: Any) -> Any:
+    # Decimals are sent as strings so no precision is lost on the way to the client
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    return str(value)
+
+
+def render_columnar(description: Sequence[Sequence[Any]], rows: Sequence[Sequence[Any]]) -> dict[str, Any]:
+    """
+    Typed column metadata plus one array of values per column, so column names are sent once
+    instead of once per row.
+    """
+    return {
+        "format": "columnar",
+        "columns": column_metadata(description),
+        "data": [[json_value(row[index]) for row in rows] for index in range(len(description))],
+    }
+
+
+def render_arrow(description: Sequence[Sequence[Any]], rows: Sequence[Sequence[Any]]) -> dict[str, Any]:
+    """
+    The rows as a base64 encoded Arrow IPC stream. Falls back to render_columnar when pyarrow isn't installed.
+    """
+    if pyarrow is None:
+        return render_columnar(description, rows)
+    arrays = []
+    for index in range(len(description)):
+        values = [row[index] for row in rows]
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            arrays.append(pyarrow.array([None if value is None else str(value) for value in values]))
+    table = pyarrow.Table.from_arrays(arrays, names=[column[0] for column in description])
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return {
+        "format": "arrow",
+        "columns": column_metadata(description),
+        "data": base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii"),
+    }
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class SchemaUnavailableError(Exception):
+    pass
+
+
+class SchemaCatalog:
+    """
+    Per-process copy of the table descriptions sent to the prompts, refreshed only when the database schema changes.
+    Attributes:
+        tables (list): One "schema.table (column, ...)" line per table.
+        objects (list): Views and synonyms, which the prompts don't describe but queries may still use. Same format
+            as tables, without the column list when the columns aren't known.
+        version (str): Fingerprint of the schema the tables were loaded from, None until the first load.
+        check_interval (float): Seconds between cheap version checks against the database.
+    Methods:
+        get(self): Returns the table descriptions, waiting only if nothing has been loaded yet. Raises
+            SchemaUnavailableError while nothing is loaded and the last attempt failed less than check_interval ago.
+        invalidate(self): Forces the next call to get() to check the schema version.
+    """
+
+    def __init__(
+        self,
+        load_tables: Callable[[str], Awaitable[list[str]]],
+        load_version: Callable[[], Awaitable[str]],
+        check_interval: float = 60,
+        load_objects: Optional[Callable[[str], Awaitable[list[str]]]] = None,
+    ):
+        self.load_tables = load_tables
+        self.load_version = load_version
+        self.load_objects = load_objects
+        self.check_interval = check_interval
+        self.tables: list[str] = []
+        self.objects: list[str] = []
+        self.version: Optional[str] = None
+        self._text = ""
+        self._checked_at = 0.0
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._last_error: Optional[BaseException] = None
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    async def get(self) -> str:
+        if self.version is None:
+            recently_failed = time.monotonic() - self._checked_at < self.check_interval
+            if self._refresh_task is None and self._last_error is not None and recently_failed:
+                # Don't make every request wait on an unreachable database, the next interval tries again
+                raise SchemaUnavailableError("The database schema could not be loaded yet") from self._last_error
+            # Nothing to serve yet, so every caller waits on the same load
+            await asyncio.shield(self._start_refresh())
+        elif time.monotonic() - self._checked_at >= self.check_interval and self._refresh_task is None:
+            # Serve the copy we have while a single background task checks for changes
+            self._start_refresh().add_done_callback(self._log_refresh_failure)
+        return self._text
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def _start_refresh(self) -> asyncio.Task:
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self):
+        try:
+            # Read the version before the tables so a change made in between is picked up by the next check
+            version = await self.load_version()
+            if version != self.version:
+                tables = await self.load_tables(version)
+                objects = await self.load_objects(version) if self.load_objects is not None else []
+                self.tables = tables
+                self.objects = objects
+                self._text = "".join(table + "\n" for table in tables)
+                self.version = version
+                logging.info("Loaded %d tables for schema version %s", len(tables), version)
+            self._last_error = None
+        except Exception as e:
+            self._last_error = e
+            raise
+        finally:
+            # Also set on failure so an unreachable database is retried once per interval, not on every request
+            self._checked_at = time.monotonic()
+            self._refresh_task = None
+
+    @staticmethod
+    def _log_refresh_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Schema refresh failed, serving the previous copy", exc_info=task.exception())
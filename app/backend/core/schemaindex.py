@@ -0,0 +1,138 @@
+import math
+import re
+from collections import Counter
+from typing import Callable, Optional
+
+IDENTIFIER_PARTS = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+TABLE_LINE = re.compile(r"^\s*(?P<table>[^(]+?)\s*\((?P<columns>.*)\)\s*$")
+
+# Words that show up in most questions but say nothing about which table is meant
+STOP_WORDS = frozenset(
+    "a an and are as at by count do does for from get give how i in is it list many me much of on or per "
+    "show that the their them there these this to total was were what when where which who with".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits text or SQL identifiers into lowercase terms. CamelCase, snake_case and dotted names are split into
+    their parts and a trailing plural "s" is dropped, so "OrderLines" and "order_line" both give ["order", "line"].
+    """
+    terms = []
+    for part in IDENTIFIER_PARTS.findall(text):
+        term = part.lower()
+        if term in STOP_WORDS:
+            continue
+        if len(term) > 3 and term.endswith("s") and not term.endswith("ss"):
+            term = term[:-1]
+        terms.append(term)
+    return terms
+
+
+class SchemaTable:
+    def __init__(self, line: str):
+        self.line = line
+        match = TABLE_LINE.match(line)
+        self.name = match.group("table") if match else line.strip()
+        self.columns = [c.strip() for c in match.group("columns").split(",")] if match else []
+        # Short table name without the schema, used to spot foreign key style columns such as CustomerID
+        self.short_name = self.name.rsplit(".", 1)[-1].lower()
+        self.name_terms = Counter(tokenize(self.name))
+        self.column_terms = Counter(term for column in self.columns for term in tokenize(column))
+        self.token_count: Optional[int] = None
+
+
+class SchemaIndex:
+    """
+    Local BM25 index over table and column names used to send only the relevant part of a large schema to the model.
+    Attributes:
+        tables (list): Parsed tables in catalog order.
+        version (str): Schema version the index was built from.
+    Methods:
+        select(self, question, top_k, token_limit, count_tokens): Returns the table description lines to send.
+    """
+
+    # Matches in the table name count more than matches in a column name
+    name_weight = 3.0
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, lines: list[str], version: Optional[str] = None):
+        self.version = version
+        self.tables = [SchemaTable(line) for line in lines if line.strip()]
+        self.by_short_name: dict[str, list[SchemaTable]] = {}
+        document_frequency: Counter = Counter()
+        total_length = 0
+        for table in self.tables:
+            self.by_short_name.setdefault(table.short_name, []).append(table)
+            document_frequency.update(set(table.name_terms) | set(table.column_terms))
+            total_length += self._length(table)
+        self.average_length = total_length / len(self.tables) if self.tables else 0.0
+        table_count = len(self.tables)
+        self.idf = {
+            term: math.log(1 + (table_count - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def _length(self, table: SchemaTable) -> float:
+        return self.name_weight * sum(table.name_terms.values()) + sum(table.column_terms.values())
+
+    def score(self, table: SchemaTable, query_terms: Counter) -> float:
+        length_norm = self.k1 * (1 - self.b + self.b * self._length(table) / (self.average_length or 1))
+        score = 0.0
+        for term, query_count in query_terms.items():
+            frequency = self.name_weight * table.name_terms.get(term, 0) + table.column_terms.get(term, 0)
+            if frequency:
+                score += query_count * self.idf.get(term, 0.0) * frequency * (self.k1 + 1) / (frequency + length_norm)
+        return score
+
+    def rank(self, question: str) -> list[SchemaTable]:
+        query_terms = Counter(tokenize(question))
+        scored = [(self.score(table, query_terms), position, table) for position, table in enumerate(self.tables)]
+        # Ties, including all the tables that matched nothing, keep catalog order
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [table for _, _, table in scored]
+
+    def related(self, table: SchemaTable) -> list[SchemaTable]:
+        # Tables referenced through columns named like CustomerID or customer_id
+        related = []
+        for column in table.columns:
+            lowered = column.lower()
+            for suffix in ("_id", "_key", "id", "key"):
+                if lowered.endswith(suffix) and len(lowered) > len(suffix):
+                    prefix = lowered[: -len(suffix)]
+                    related.extend(self.by_short_name.get(prefix, []) + self.by_short_name.get(prefix + "s", []))
+                    break
+        return [other for other in related if other is not table]
+
+    def select(self, question: str, top_k: int, token_limit: int, count_tokens: Callable[[str], int]) -> list[str]:
+        def tokens(table: SchemaTable) -> int:
+            if table.token_count is None:
+                table.token_count = count_tokens(table.line + "\n")
+            return table.token_count
+
+        if len(self.tables) <= top_k and sum(tokens(table) for table in self.tables) <= token_limit:
+            return [table.line for table in self.tables]
+
+        selected: list[SchemaTable] = []
+        chosen = set()
+        used_tokens = 0
+
+        def add(table: SchemaTable) -> bool:
+            nonlocal used_tokens
+            if id(table) in chosen or len(selected) >= top_k:
+                return False
+            if used_tokens + tokens(table) > token_limit:
+                return False
+            chosen.add(id(table))
+            selected.append(table)
+            used_tokens += tokens(table)
+            return True
+
+        for table in self.rank(question):
+            if len(selected) >= top_k or token_limit - used_tokens < 16:
+                break
+            if add(table):
+                for other in self.related(table):
+                    add(other)
+        return [table.line for table in selected]
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import ssl
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Hashable, Optional
+from urllib.parse import unquote, urlparse
+
+from .cache import LRUCache, fingerprint
+
+
+class SharedCacheReplyError(RuntimeError):
+    pass
+
+
+class SharedCache(ABC):
+    """
+    A cache shared by every worker process, and possibly every host, that serves the app.
+    Values must be JSON serializable. Backends treat their own failures as misses, a shared cache is an optimization.
+    """
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SQLiteSharedCache(SharedCache):
+    """
+    Shares entries between the workers on one host through a SQLite file in WAL mode.
+    """
+
+    purge_interval = 300
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._purged_at = time.time()
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await asyncio.to_thread(self._set, key, json.dumps(value, ensure_ascii=False), time.time() + ttl)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._execute, "DELETE FROM cache WHERE key = ?", (key,))
+
+    async def incr(self, key: str) -> int:
+        return await asyncio.to_thread(self._incr, key)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, parameters).fetchall()
+
+    def _get(self, key: str) -> Optional[Any]:
+        try:
+            rows = self._execute("SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time()))
+        except sqlite3.Error:
+            logging.warning("Shared cache read failed for %s", key, exc_info=True)
+            return None
+        return json.loads(rows[0][0]) if rows else None
+
+    def _set(self, key: str, value: str, expires_at: float):
+        try:
+            self._execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+            if time.time() - self._purged_at > self.purge_interval:
+                self._purged_at = time.time()
+                self._execute("DELETE FROM cache WHERE expires_at <= ?", (self._purged_at,))
+        except sqlite3.Error:
+            logging.warning("Shared cache write failed for %s", key, exc_info=True)
+
+    def _incr(self, key: str) -> int:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchall()
+                value = int(json.loads(rows[0][0])) + 1 if rows else 1
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (key, str(value), float("inf"))
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return value
+
+
+class RedisSharedCache(SharedCache):
+    """
+    Talks the Redis protocol (RESP) directly, so it works with Redis, Azure Cache for Redis or any compatible
+    server, including a local stand-in, without an extra client dependency.
+    Commands run on a small pool of connections. When the server can't be reached or doesn't answer within
+    timeout, the cache is treated as down for down_for seconds and every command is a miss until then, so an
+    outage doesn't add a timeout to each lookup.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 6379,
+        password: Optional[str] = None,
+        username: Optional[str] = None,
+        db: int = 0,
+        use_ssl: bool = False,
+        timeout: float = 2,
+        pool_size: int = 8,
+        down_for: float = 30,
+    ):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.username = username
+        self.db = db
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.down_for = down_for
+        self._idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._slots = asyncio.Semaphore(pool_size)
+        self._down_until = 0.0
+
+    @property
+    def is_down(self) -> bool:
+        return time.monotonic() < self._down_until
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = await self._command_or_none("GET", key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any, ttl: float):
+        await self._command_or_none("SET", key, json.dumps(value, ensure_ascii=False), "PX", str(int(ttl * 1000)))
+
+    async def delete(self, key: str):
+        await self._command_or_none("DEL", key)
+
+    async def incr(self, key: str) -> int:
+        return int(await self._command("INCR", key))
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def _command_or_none(self, *args: str) -> Any:
+        if self.is_down:
+            return None
+        try:
+            return await self._command(*args)
+        except Exception as e:
+            logging.warning("Shared cache %s failed: %s", args[0], e)
+            return None
+
+    async def _command(self, *args: str) -> Any:
+        async with self._slots:
+            # Checked again after waiting for a slot, the server may have been marked down meanwhile
+            if self.is_down:
+                raise ConnectionError(f"Shared cache {self.host}:{self.port} is down")
+            while True:
+                reused = bool(self._idle)
+                connection = None
+                try:
+                    connection = self._idle.pop() if reused else await self._connect()
+                    reply = await asyncio.wait_for(self._send(connection, *args), self.timeout)
+                except SharedCacheReplyError:
+                    # An error reply leaves the connection in a known state
+                    self._idle.append(connection)
+                    raise
+                except BaseException as e:
+                    # The reply stream is in an unknown state, start over with a new connection
+                    if connection is not None:
+                        connection[1].close()
+                    if reused and isinstance(e, ConnectionError):
+                        # The server closed an idle connection, that says nothing about whether it's up
+                        continue
+                    if isinstance(e, (OSError, asyncio.TimeoutError)):
+                        self._mark_down(e)
+                    raise
+                self._idle.append(connection)
+                return reply
+
+    def _mark_down(self, error: BaseException):
+        if not self.is_down:
+            logging.warning(
+                "Shared cache %s:%s is unreachable (%r), skipping it for %ss", self.host, self.port, error, self.down_for
+            )
+        self._down_until = time.monotonic() + self.down_for
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def _connect(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        ssl_context = ssl.create_default_context() if self.use_ssl else None
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context), self.timeout
+        )
+        try:
+            if self.password:
+                auth = ("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)
+                await asyncio.wait_for(self._send(connection, *auth), self.timeout)
+            if self.db:
+                await asyncio.wait_for(self._send(connection, "SELECT", str(self.db)), self.timeout)
+        except BaseException:
+            connection[1].close()
+            raise
+        return connection
+
+    async def _send(self, connection: tuple[asyncio.StreamReader, asyncio.StreamWriter], *args: str) -> Any:
+        reader, writer = connection
+        encoded = [arg.encode("utf-8") for arg in args]
+        writer.write(
+            b"*%d\r\n" % len(encoded) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in encoded)
+        )
+        await writer.drain()
+        return await self._read_reply(reader)
+
+    async def _read_reply(self, reader: asyncio.StreamReader) -> Any:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Shared cache connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise SharedCacheReplyError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await reader.readexactly(length + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            count = int(payload)
+            return None if count < 0 else [await self._read_reply(reader) for _ in range(count)]
+        raise ConnectionError(f"Unexpected reply from shared cache: {line!r}")
+
+
+def create_shared_cache(url: Optional[str]) -> Optional[SharedCache]:
+    """
+    Builds a shared cache from a URL such as sqlite:////tmp/data-chat-cache.db, redis://:password@host:6379/0
+    or rediss://host:6380 (TLS). Returns None when no URL is configured.
+    """
+    if not url:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        return SQLiteSharedCache(unquote(parsed.path))
+    if parsed.scheme in ("redis", "rediss"):
+        return RedisSharedCache(
+            host=parsed.hostname or "localhost",
+            port=parsed.port or 6379,
+            username=unquote(parsed.username) if parsed.username else None,
+            password=unquote(parsed.password) if parsed.password else None,
+            db=int(parsed.path.lstrip("/") or 0),
+            use_ssl=parsed.scheme == "rediss",
+        )
+    raise ValueError(f"Unsupported shared cache URL scheme: {parsed.scheme}")
+
+
+class TieredCache:
+    """
+    An in-process LRUCache in front of an optional SharedCache. Reads try the local layer first and copy shared
+    hits into it. Clearing bumps a generation counter in the shared cache, so every worker stops seeing the old
+    entries within generation_check_interval seconds.
+    Attributes:
+        local (LRUCache): First, per-process layer.
+        shared (SharedCache): Second layer shared across workers, None when not configured.
+        namespace (str): Prefix that keeps different caches apart in the shared layer.
+    """
+
+    generation_check_interval = 5
+
+    def __init__(self, local: LRUCache, shared: Optional[SharedCache], namespace: str):
+        self.local = local
+        self.shared = shared
+        self.namespace = namespace
+        self.shared_hits = 0
+        self._generation = 0
+        self._generation_checked_at = 0.0
+
+    @property
+    def hits(self) -> int:
+        return self.local.hits + self.shared_hits
+
+    @property
+    def misses(self) -> int:
+        return self.local.misses - self.shared_hits
+
+    async def get(self, key: Hashable) -> Optional[Any]:
+        if self.shared is None or self.local.maxsize <= 0:
+            return self.local.get(key)
+        await self._check_generation()
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        value = await self.shared.get(self._shared_key(key))
+        if value is not None:
+            self.shared_hits += 1
+            self.local.set(key, value)
+        return value
+
+    async def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if self.local.maxsize <= 0:
+            return
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            await self._check_generation()
+            await self.shared.set(self._shared_key(key), value, self.local.ttl if ttl is None else ttl)
+
+    async def delete_where(self, predicate: Callable[[Hashable], bool]):
+        # The shared layer can't be scanned cheaply, so a partial invalidation retires the whole shared generation
+        self.local.delete_where(predicate)
+        await self._bump_generation()
+
+    async def clear(self):
+        self.local.clear()
+        await self._bump_generation()
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.local.hits + self.local.misses
+        return {
+            **self.local.stats(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "shared_hits": self.shared_hits,
+        }
+
+    async def _check_generation(self):
+        if time.monotonic() - self._generation_checked_at < self.generation_check_interval:
+            return
+        self._generation_checked_at = time.monotonic()
+        generation = await self.shared.get(f"{self.namespace}:generation")
+        if generation is not None and generation != self._generation:
+            # Another worker cleared this cache
+            self._generation = generation
+            self.local.clear()
+
+    def _shared_key(self, key: Hashable) -> str:
+        return f"{self.namespace}:{self._generation}:{fingerprint(key)}"
+
+    async def _bump_generation(self):
+        if self.shared is None:
+            return
+        try:
+            self._generation = await self.shared.incr(f"{self.namespace}:generation")
+            self._generation_checked_at = time.monotonic()
+        except Exception:
+            logging.warning("Unable to invalidate shared cache %s", self.namespace, exc_info=True)
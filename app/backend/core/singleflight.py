@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one execution whose result, or exception, every caller gets.
+    The shared call keeps running if the caller that started it goes away, as long as others still wait on it.
+    Methods:
+        do(self, key, fn): Awaits fn() or the call already in flight for key. Returns (result, shared).
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self._calls[key] = call
+            call.add_done_callback(lambda _: self._forget(key, call))
+        return await asyncio.shield(call), shared
+
+    def _forget(self, key: Hashable, call: asyncio.Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.cancelled():
+            # Mark the exception as retrieved, the callers that awaited it have seen it
+            call.exception()
+
+
+class _Broadcast:
+    def __init__(self, source: AsyncIterator[Any]):
+        self.source = source
+        self.events: list[Any] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    async def pump(self):
+        try:
+            async for event in self.source:
+                async with self.changed:
+                    self.events.append(event)
+                    self.changed.notify_all()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("The shared stream was cancelled")
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+
+
+class StreamFlight:
+    """
+    Collapses concurrent streams with the same key into one source stream whose events are fanned out to every
+    subscriber. Subscribers that join late first receive the events they missed, so each gets the complete stream.
+    The source is cancelled when its last subscriber disconnects.
+    Methods:
+        subscribe(self, key, start): Returns a stream of the events of start(), or of the stream already in flight for key.
+        is_shared(self, key): Whether a stream for key is in flight.
+    """
+
+    def __init__(self):
+        self._streams: dict[Hashable, _Broadcast] = {}
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def is_shared(self, key: Hashable) -> bool:
+        return key in self._streams
+
+    async def subscribe(self, key: Hashable, start: Callable[[], AsyncIterator[Any]]) -> AsyncGenerator[Any, None]:
+        # Joined on first iteration, so a stream that is never iterated doesn't hold the source open
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            broadcast = _Broadcast(start())
+            self._streams[key] = broadcast
+            broadcast.task = asyncio.create_task(broadcast.pump())
+            broadcast.task.add_done_callback(lambda _: self._forget(key, broadcast))
+        broadcast.subscribers += 1
+        try:
+            position = 0
+            while True:
+                async with broadcast.changed:
+                    await broadcast.changed.wait_for(lambda: position < len(broadcast.events) or broadcast.done)
+                    events = broadcast.events[position:]
+                    done = broadcast.done
+                position += len(events)
+                for event in events:
+                    yield event
+                if done and position == len(broadcast.events):
+                    break
+            if broadcast.error is not None:
+                raise broadcast.error
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.task.done():
+                logging.debug("Last subscriber left, cancelling the shared stream")
+                broadcast.task.cancel()
+            if broadcast.done or broadcast.subscribers == 0:
+                self._forget(key, broadcast)
+
+    def _forget(self, key: Hashable, broadcast: _Broadcast):
+        if self._streams.get(key) is broadcast:
+            del self._streams[key]
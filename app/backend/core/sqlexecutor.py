@@ -0,0 +1,64 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class QueryQueueFullError(Exception):
+    pass
+
+
+class QueryTimeoutError(Exception):
+    pass
+
+
+class QueryExecutor:
+    """
+    Runs blocking database calls on a dedicated, size-limited thread pool so they never block the event loop.
+    Attributes:
+        max_workers (int): Number of threads executing database calls at the same time.
+        max_queue_depth (int): Calls allowed to wait for a free thread before new ones are rejected.
+        timeout (float): Default number of seconds to wait for a call before raising QueryTimeoutError.
+    Methods:
+        run(self, fn, *args, timeout=None): Runs fn(*args) on the pool and awaits its result.
+        shutdown(self): Stops accepting work and releases the threads.
+    """
+
+    def __init__(self, max_workers: int = 10, max_queue_depth: int = 50, timeout: float = 60):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sql")
+        # Calls submitted to the pool that haven't finished, including ones the caller gave up on after a timeout
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def run(self, fn: Callable[..., Any], *args: Any, timeout: Optional[float] = None) -> Any:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue_depth:
+                raise QueryQueueFullError(f"{self._pending} database calls are already running or queued")
+            self._pending += 1
+        try:
+            # Run in a copy of the caller's context so tracing spans opened in the thread nest under the request
+            future = self._executor.submit(contextvars.copy_context().run, functools.partial(fn, *args))
+        except BaseException:
+            self._done()
+            raise
+        future.add_done_callback(lambda _: self._done())
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise QueryTimeoutError(f"Database call did not finish within {timeout or self.timeout} seconds")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
@@ -0,0 +1,112 @@
+import contextlib
+import logging
+import xml.etree.ElementTree as ElementTree
+from typing import Any, Iterator, Optional
+
+SHOWPLAN_NAMESPACE = "{http://schemas.microsoft.com/sqlserver/2004/07/showplan}"
+# SQL Server error 262, raised for users without the SHOWPLAN permission such as plain db_datareader members
+SHOWPLAN_PERMISSION_ERRORS = ("(262)", "SHOWPLAN permission denied")
+
+
+class QueryRejectedError(Exception):
+    def __init__(self, message: str, decision: dict[str, Any]):
+        super().__init__(message)
+        self.decision = decision
+
+
+class QueryGuard:
+    """
+    Checks generated SQL before it runs and bounds what it can do while it runs.
+    Attributes:
+        max_cost (float): Highest estimated subtree cost allowed, 0 disables the plan check.
+        plans_denied (bool): Set once the database refuses SHOWPLAN, the plan check is skipped from then on.
+        timeout (int): Seconds a statement may run, also used as the lock wait limit.
+    Methods:
+        estimate_cost(self, conn, sql_query): Returns the optimizer's estimated cost from SET SHOWPLAN_XML.
+        check(self, conn, sql_query, row_cap): Returns the guard decision, raises QueryRejectedError over max_cost.
+        limits(self, conn, row_cap): Context manager that applies SET ROWCOUNT and SET LOCK_TIMEOUT to one query.
+    """
+
+    def __init__(self, max_cost: float = 1000, timeout: int = 60):
+        self.max_cost = max_cost
+        self.timeout = timeout
+        self.plans_denied = False
+
+    def estimate_cost(self, conn: Any, sql_query: str) -> Optional[float]:
+        cursor = conn.cursor()
+        try:
+            # With SHOWPLAN_XML on, the statement is compiled but not executed and the plan comes back as one row
+            cursor.execute("SET SHOWPLAN_XML ON")
+            try:
+                cursor.execute(sql_query)
+                plan = cursor.fetchone()[0]
+                while cursor.nextset():
+                    pass
+            finally:
+                self._reset(conn, cursor, "SET SHOWPLAN_XML OFF")
+        finally:
+            with contextlib.suppress(Exception):
+                cursor.close()
+        costs = [
+            float(statement.attrib["StatementSubTreeCost"])
+            for statement in ElementTree.fromstring(plan).iter(f"{SHOWPLAN_NAMESPACE}StmtSimple")
+            if "StatementSubTreeCost" in statement.attrib
+        ]
+        return sum(costs) if costs else None
+
+    def check(self, conn: Any, sql_query: str, row_cap: int) -> dict[str, Any]:
+        decision = {
+            "action": "unchecked",
+            "estimated_cost": None,
+            "max_cost": self.max_cost,
+            "row_cap": row_cap,
+            "timeout": self.timeout,
+        }
+        if self.max_cost <= 0 or self.plans_denied:
+            return decision
+        try:
+            decision["estimated_cost"] = self.estimate_cost(conn, sql_query)
+        except Exception as e:
+            # The limits still apply without an estimate
+            if any(marker in str(e) for marker in SHOWPLAN_PERMISSION_ERRORS):
+                # A permission doesn't come and go between queries, so stop paying for the failing round trip
+                self.plans_denied = True
+                logging.warning("The database user lacks SHOWPLAN permission, query cost checks are disabled: %s", e)
+            else:
+                logging.warning("Unable to estimate the cost of the query, running it with limits only: %s", e)
+            return decision
+        if decision["estimated_cost"] is None:
+            return decision
+        if decision["estimated_cost"] > self.max_cost:
+            decision["action"] = "rejected"
+            raise QueryRejectedError(
+                f"The query was not run because its estimated cost ({decision['estimated_cost']:.1f}) is above "
+                f"the limit of {self.max_cost:g}. Try a more specific question or add filters.",
+                decision,
+            )
+        decision["action"] = "allowed"
+        return decision
+
+    @contextlib.contextmanager
+    def limits(self, conn: Any, row_cap: int) -> Iterator[None]:
+        # The server stops producing rows after row_cap, instead of the client cancelling a large result
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SET ROWCOUNT {int(row_cap)}; SET LOCK_TIMEOUT {int(self.timeout * 1000)}")
+            try:
+                yield
+            finally:
+                self._reset(conn, cursor, "SET ROWCOUNT 0; SET LOCK_TIMEOUT -1")
+        finally:
+            with contextlib.suppress(Exception):
+                cursor.close()
+
+    @staticmethod
+    def _reset(conn: Any, cursor: Any, statement: str):
+        try:
+            cursor.execute(statement)
+        except Exception:
+            # Session options outlive the query, a connection that may still have them set must not go back to the pool.
+            # Closing it makes the pool's rollback fail, which discards the connection.
+            conn.close()
+            raise
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PooledConnection:
+    """
+    Bookkeeping wrapper around a DB-API connection handed out by ConnectionPool.
+    """
+
+    def __init__(self, conn: Any):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.last_checked = self.created_at
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of DB-API connections shared by every request served by this worker.
+    Attributes:
+        min_size (int): Idle connections kept open even after they pass idle_timeout.
+        max_size (int): Upper bound on open connections, idle and in use.
+        idle_timeout (float): Seconds after which surplus idle connections are closed.
+        health_check_interval (float): Idle connections older than this are pinged before being handed out.
+        acquire_timeout (float): Seconds to wait for a free connection before raising PoolTimeoutError.
+    Methods:
+        connection(self): Context manager that checks a connection out and returns or recycles it afterwards.
+        fill(self): Opens connections until min_size are available.
+        close(self): Closes every idle connection and stops handing out new ones.
+    """
+
+    health_check_query = "SELECT 1"
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        min_size: int = 1,
+        max_size: int = 10,
+        idle_timeout: float = 300,
+        health_check_interval: float = 30,
+        acquire_timeout: float = 30,
+    ):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError("Expected 0 <= min_size <= max_size and max_size >= 1")
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle: deque[PooledConnection] = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def idle_count(self) -> int:
+        return len(self._idle)
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        pooled = self.acquire()
+        try:
+            yield pooled.conn
+        except Exception:
+            # Roll back whatever the failed statement left behind. If even that fails the session is
+            # unusable (dropped link, killed SPID, expired token), so recycle it instead of pooling it.
+            self.release(pooled, discard=not self._try_rollback(pooled))
+            raise
+        else:
+            self.release(pooled)
+
+    def acquire(self) -> PooledConnection:
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeoutError("Connection pool is closed")
+                self._reap_idle()
+                pooled = self._idle.pop() if self._idle else None
+                if pooled is None:
+                    if self._size < self.max_size:
+                        # Reserve the slot now and open the connection outside the lock
+                        self._size += 1
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise PoolTimeoutError(f"Timed out waiting for one of {self.max_size} SQL connections")
+                        self._cond.wait(remaining)
+                        continue
+
+            if pooled is None:
+                try:
+                    return PooledConnection(self.connect())
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(pooled):
+                return pooled
+            self._discard(pooled)
+
+    def fill(self):
+        opened = []
+        try:
+            while len(opened) < self.min_size:
+                opened.append(self.acquire())
+        finally:
+            for pooled in opened:
+                self.release(pooled)
+
+    def release(self, pooled: PooledConnection, discard: bool = False):
+        if discard:
+            self._discard(pooled)
+            return
+        # A connection that just ran a statement successfully doesn't need pinging again soon
+        pooled.last_used = pooled.last_checked = time.monotonic()
+        with self._cond:
+            if not self._closed:
+                self._idle.append(pooled)
+                self._cond.notify()
+                return
+        self._discard(pooled)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+    def _reap_idle(self):
+        # Called with the lock held. The deque is ordered oldest-returned first.
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0].last_used > self.idle_timeout:
+            pooled = self._idle.popleft()
+            self._size -= 1
+            self._close_quietly(pooled)
+
+    def _is_healthy(self, pooled: PooledConnection) -> bool:
+        now = time.monotonic()
+        if now - pooled.last_checked < self.health_check_interval:
+            return True
+        try:
+            cursor = pooled.conn.cursor()
+            try:
+                cursor.execute(self.health_check_query)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+        except Exception:
+            logging.warning("Pooled SQL connection failed its health check, recycling it")
+            return False
+        pooled.last_checked = now
+        return True
+
+    def _try_rollback(self, pooled: PooledConnection) -> bool:
+        try:
+            pooled.conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, pooled: PooledConnection):
+        self._close_quietly(pooled)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(pooled: PooledConnection):
+        try:
+            pooled.conn.close()
+        except Exception:
+            logging.debug("Ignoring error while closing pooled SQL connection", exc_info=True)
@@ -0,0 +1,107 @@
+import logging
+import struct
+import threading
+import time
+from typing import Optional
+
+from azure.core.credentials import AccessToken, TokenCredential
+
+# This connection option is defined by microsoft in msodbcsql.h
+SQL_COPT_SS_ACCESS_TOKEN = 1256
+
+
+class SqlTokenManager:
+    """
+    Keeps the packed SQL_COPT_SS_ACCESS_TOKEN struct for Azure SQL in memory and refreshes it before it expires.
+    Attributes:
+        credential (TokenCredential): Credential used to request tokens for Azure SQL.
+        refresh_margin (float): Seconds before expiry at which a background refresh is started.
+    Methods:
+        get_token_struct(self): Returns the packed token struct, blocking only when no valid token is held.
+        close(self): Cancels the scheduled background refresh.
+    """
+
+    scope: str = "https://database.windows.net/.default"
+
+    def __init__(self, credential: TokenCredential, refresh_margin: float = 300):
+        self.credential = credential
+        self.refresh_margin = refresh_margin
+        # The token and its packed struct, swapped together so readers never see a mismatched pair
+        self._current: Optional[tuple[AccessToken, bytes]] = None
+        # Guards the refresh flag and timer, never held across a network call
+        self._lock = threading.Lock()
+        # Serializes token requests, held while the credential is called
+        self._fetch_lock = threading.Lock()
+        self._refreshing = False
+        self._timer: Optional[threading.Timer] = None
+        self._closed = False
+
+    @staticmethod
+    def pack_token(token: str) -> bytes:
+        token_bytes = token.encode("UTF-16-LE")
+        return struct.pack(f"<I{len(token_bytes)}s", len(token_bytes), token_bytes)
+
+    def get_token_struct(self) -> bytes:
+        current = self._current
+        now = time.time()
+        if current is not None and current[0].expires_on - now > self.refresh_margin:
+            return current[1]
+        if current is not None and current[0].expires_on - now > 60:
+            # Still usable, let one background refresh replace it while callers keep going
+            self._start_background_refresh()
+            return current[1]
+        # No usable token. The first caller fetches one while everyone else waits on the fetch lock and
+        # then picks up the token it fetched instead of requesting their own.
+        with self._fetch_lock:
+            current = self._current
+            if current is None or current[0].expires_on - time.time() <= 60:
+                current = self._refresh()
+            return current[1]
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def _refresh(self) -> tuple[AccessToken, bytes]:
+        # Called with the fetch lock held, the state lock is only taken to swap in the result
+        token = self.credential.get_token(self.scope)
+        current = (token, self.pack_token(token.token))
+        with self._lock:
+            self._current = current
+            self._schedule_refresh(token)
+        return current
+
+    def _schedule_refresh(self, token: AccessToken):
+        # Called with the state lock held
+        if self._closed:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = max(token.expires_on - time.time() - self.refresh_margin, 0)
+        self._timer = threading.Timer(delay, self._start_background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _start_background_refresh(self):
+        with self._lock:
+            if self._refreshing or self._closed:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._background_refresh, name="sql-token-refresh", daemon=True)
+        thread.start()
+
+    def _background_refresh(self):
+        try:
+            with self._fetch_lock:
+                current = self._current
+                if current is not None and current[0].expires_on - time.time() > self.refresh_margin:
+                    return
+                self._refresh()
+        except Exception:
+            logging.exception("Failed to refresh Azure SQL access token, will retry on next use")
+        finally:
+            with self._lock:
+                self._refreshing = False
@@ -0,0 +1,318 @@
+import difflib
+import re
+from typing import Optional
+
+from .schemaindex import SchemaTable
+
+
+class SqlValidationError(Exception):
+    def __init__(self, message: str, problems: list[str], fixable: bool):
+        super().__init__(message)
+        self.problems = problems
+        self.fixable = fixable
+
+
+# Comments, literals and quoted identifiers come first so nothing inside them is read as a keyword. An opening
+# quote, bracket or comment that none of them could match is unterminated.
+SQL_TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+)
+    |(?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<string>N?'(?:[^']|'')*')
+    |(?P<quoted>\[(?:[^\]]|\]\])*\]|"(?:[^"]|"")*")
+    |(?P<unterminated>['"\[]|/\*)
+    |(?P<number>0x[0-9a-fA-F]*|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<word>[^\W\d][\w@#$]*|[@#][\w@#$]*)
+    |(?P<symbol><>|!=|<=|>=|!<|!>|\|\||[-+*/%=<>(),.;~&|^:!])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+# Statements and functions that change data or schema, or reach outside the database
+WRITE_KEYWORDS = frozenset(
+    "ALTER BACKUP BULK CREATE DBCC DELETE DENY DROP EXEC EXECUTE GRANT INSERT INTO KILL MERGE OPENDATASOURCE "
+    "OPENQUERY OPENROWSET RECONFIGURE RESTORE REVOKE SHUTDOWN TRUNCATE UPDATE USE WAITFOR".split()
+)
+
+# Words that can follow a table reference, anything else there is an alias
+CLAUSE_KEYWORDS = frozenset(
+    "APPLY CROSS EXCEPT FOR FULL GROUP HAVING INNER INTERSECT JOIN LEFT ON OPTION ORDER OUTER PIVOT RIGHT "
+    "TABLESAMPLE UNION UNPIVOT WHERE WINDOW WITH".split()
+)
+
+SYSTEM_SCHEMAS = frozenset(("sys", "information_schema"))
+
+
+class SqlToken:
+    def __init__(self, kind: str, text: str):
+        self.kind = kind
+        self.text = text
+        self.upper = text.upper() if kind == "word" else text
+
+    @property
+    def identifier(self) -> Optional[str]:
+        # Lowercased name for words and quoted identifiers, the default collation is case insensitive
+        if self.kind == "word":
+            return self.text.lower()
+        if self.kind == "quoted":
+            closing = "]]" if self.text.startswith("[") else '""'
+            return self.text[1:-1].replace(closing, closing[0]).lower()
+        return None
+
+
+def tokenize_sql(sql_query: str) -> list[SqlToken]:
+    tokens = []
+    position = 0
+    while position < len(sql_query):
+        match = SQL_TOKEN_PATTERN.match(sql_query, position)
+        if match is None or match.lastgroup == "unterminated":
+            text = sql_query[position : position + 20]
+            raise SqlValidationError(
+                f"Syntax error near {text!r}", [f"Unterminated literal, identifier or comment near {text!r}"], True
+            )
+        if match.lastgroup not in ("space", "comment"):
+            tokens.append(SqlToken(match.lastgroup, match.group(0)))
+        position = match.end()
+    return tokens
+
+
+class SqlValidator:
+    """
+    Checks generated T-SQL against the schema catalog without a database round trip: one read-only SELECT
+    statement, balanced parentheses, tables that exist and qualified columns that exist in their table.
+    Unqualified columns are left to the server, they can't be told apart from select list aliases without a
+    full parser.
+    Attributes:
+        tables (dict): Column names by their lowercase form, per lowercase "schema.table" name. None for views
+            and synonyms whose columns aren't known.
+        version (str): Schema version the tables were read from.
+    Methods:
+        validate(self, sql_query): Raises SqlValidationError listing the problems found.
+    """
+
+    def __init__(self, lines: list[str], version: Optional[str] = None, objects: list[str] = ()):
+        self.version = version
+        self.tables: dict[str, Optional[dict[str, str]]] = {}
+        self.names: dict[str, str] = {}
+        self.by_short_name: dict[str, list[str]] = {}
+        for line in [*lines, *objects]:
+            if not line.strip():
+                continue
+            table = SchemaTable(line)
+            name = ".".join(part.strip("[]") for part in table.name.split("."))
+            key = name.lower()
+            if "(" in line:
+                self.tables[key] = {column.strip("[]").lower(): column.strip("[]") for column in table.columns}
+            else:
+                self.tables[key] = None
+            self.names[key] = name
+            self.by_short_name.setdefault(key.rsplit(".", 1)[-1], []).append(key)
+
+    def validate(self, sql_query: str):
+        tokens = tokenize_sql(sql_query)
+        self._check_statement(tokens)
+        problems: list[str] = []
+        # Alias or name -> columns, None when the columns aren't known (CTEs, derived tables, system views)
+        qualifiers: dict[str, Optional[dict[str, str]]] = {}
+        table_positions: set[int] = set()
+        ctes = self._cte_names(tokens)
+        self._bind_tables(tokens, ctes, qualifiers, table_positions, problems)
+        self._bind_columns(tokens, qualifiers, table_positions, problems)
+        if problems:
+            raise SqlValidationError("; ".join(problems), problems, True)
+
+    def _check_statement(self, tokens: list[SqlToken]):
+        if not tokens:
+            raise SqlValidationError("The query is empty", ["The query is empty"], True)
+        depth = 0
+        statements = 1
+        for index, token in enumerate(tokens):
+            if token.kind == "word" and token.upper in WRITE_KEYWORDS:
+                message = f"Only SELECT queries can be run, the query uses {token.upper}"
+                raise SqlValidationError(message, [message], False)
+            if token.text == "(":
+                depth += 1
+            elif token.text == ")":
+                depth -= 1
+                if depth < 0:
+                    raise SqlValidationError("Unbalanced parentheses", ["A ')' has no matching '('"], True)
+            elif token.text == ";" and index < len(tokens) - 1:
+                statements += 1
+        if depth:
+            raise SqlValidationError("Unbalanced parentheses", [f"{depth} '(' not closed"], True)
+        if statements > 1:
+            message = "Only one statement can be run, the query has several"
+            raise SqlValidationError(message, [message], True)
+        first = next((token for token in tokens if token.text != "("), tokens[0])
+        if first.upper not in ("SELECT", "WITH"):
+            message = f"Only SELECT queries can be run, the query starts with {first.text}"
+            raise SqlValidationError(message, [message], False)
+
+    @staticmethod
+    def _read_name(tokens: list[SqlToken], index: int) -> tuple[list[str], int]:
+        # Reads a dotted name such as dbo.Orders or o.[Order Date], returns its parts and the index after it
+        parts = []
+        while index < len(tokens):
+            token = tokens[index]
+            name = "*" if parts and token.text == "*" else token.identifier
+            if name is None:
+                break
+            parts.append(name)
+            index += 1
+            if name == "*" or index >= len(tokens) or tokens[index].text != ".":
+                break
+            index += 1
+        return parts, index
+
+    @staticmethod
+    def _skip_parentheses(tokens: list[SqlToken], index: int) -> int:
+        depth = 0
+        while index < len(tokens):
+            if tokens[index].text == "(":
+                depth += 1
+            elif tokens[index].text == ")":
+                depth -= 1
+                if depth == 0:
+                    return index + 1
+            index += 1
+        return index
+
+    def _cte_names(self, tokens: list[SqlToken]) -> set[str]:
+        # WITH name [(columns)] AS (...) [, name [(columns)] AS (...)] SELECT ...
+        names: set[str] = set()
+        if tokens[0].upper != "WITH":
+            return names
+        index = 1
+        while index < len(tokens) and tokens[index].identifier is not None:
+            names.add(tokens[index].identifier)
+            index += 1
+            if index < len(tokens) and tokens[index].text == "(":
+                index = self._skip_parentheses(tokens, index)
+            if index < len(tokens) and tokens[index].upper == "AS":
+                index += 1
+            index = self._skip_parentheses(tokens, index)
+            if index >= len(tokens) or tokens[index].text != ",":
+                break
+            index += 1
+        return names
+
+    def _bind_tables(
+        self,
+        tokens: list[SqlToken],
+        ctes: set[str],
+        qualifiers: dict[str, Optional[dict[str, str]]],
+        table_positions: set[int],
+        problems: list[str],
+    ):
+        # Whether each open parenthesis holds a subquery, FROM inside a call such as TRIM(x FROM y) isn't a table list
+        subqueries: list[bool] = []
+        for index, token in enumerate(tokens):
+            if token.text == "(":
+                following = tokens[index + 1].upper if index + 1 < len(tokens) else ""
+                subqueries.append(following in ("SELECT", "WITH"))
+            elif token.text == ")" and subqueries:
+                subqueries.pop()
+            elif token.upper in ("FROM", "JOIN", "APPLY") and (not subqueries or subqueries[-1]):
+                self._bind_table_list(
+                    tokens, index + 1, token.upper == "FROM", ctes, qualifiers, table_positions, problems
+                )
+
+    def _bind_table_list(
+        self,
+        tokens: list[SqlToken],
+        index: int,
+        allow_list: bool,
+        ctes: set[str],
+        qualifiers: dict[str, Optional[dict[str, str]]],
+        table_positions: set[int],
+        problems: list[str],
+    ):
+        while index < len(tokens):
+            columns: Optional[dict[str, str]] = None
+            if tokens[index].text == "(":
+                # Derived table, its own FROM is bound separately
+                index = self._skip_parentheses(tokens, index)
+            else:
+                start = index
+                parts, index = self._read_name(tokens, index)
+                if not parts:
+                    return
+                if index < len(tokens) and tokens[index].text == "(":
+                    # Table valued function, possibly with a WITH (...) schema as OPENJSON has
+                    index = self._skip_parentheses(tokens, index)
+                    if index + 1 < len(tokens) and tokens[index].upper == "WITH" and tokens[index + 1].text == "(":
+                        index = self._skip_parentheses(tokens, index + 1)
+                else:
+                    table_positions.update(range(start, index))
+                    columns = self._resolve_table(parts, ctes, problems)
+                    name = ".".join(parts)
+                    qualifiers.setdefault(name, columns)
+                    qualifiers.setdefault(parts[-1], columns)
+            if index < len(tokens) and tokens[index].upper == "AS":
+                index += 1
+            alias = tokens[index] if index < len(tokens) else None
+            if alias is not None and alias.identifier is not None and alias.upper not in CLAUSE_KEYWORDS:
+                table_positions.add(index)
+                qualifiers[alias.identifier] = columns
+                index += 1
+            if not allow_list or index >= len(tokens) or tokens[index].text != ",":
+                return
+            index += 1
+
+    def _resolve_table(self, parts: list[str], ctes: set[str], problems: list[str]) -> Optional[dict[str, str]]:
+        if len(parts) == 1 and parts[0] in ctes:
+            return None
+        if len(parts) >= 2 and parts[-2] in SYSTEM_SCHEMAS:
+            return None
+        if len(parts) > 2:
+            # Names in another database or on a linked server can't be checked against this catalog
+            return None
+        if len(parts) >= 2:
+            name = f"{parts[-2]}.{parts[-1]}"
+            if name in self.tables:
+                return self.tables[name]
+        else:
+            candidates = self.by_short_name.get(parts[0], [])
+            if candidates:
+                # Without a schema the server picks the default one, accept the columns of any match
+                columns: dict[str, str] = {}
+                for candidate in candidates:
+                    if self.tables[candidate] is None:
+                        return None
+                    columns.update(self.tables[candidate])
+                return columns
+        problem = f"Unknown table {'.'.join(parts)}"
+        suggestions = difflib.get_close_matches(".".join(parts[-2:]), list(self.tables), n=3)
+        if suggestions:
+            problem += f", did you mean {' or '.join(self.names[suggestion] for suggestion in suggestions)}?"
+        problems.append(problem)
+        return None
+
+    def _bind_columns(
+        self,
+        tokens: list[SqlToken],
+        qualifiers: dict[str, Optional[dict[str, str]]],
+        table_positions: set[int],
+        problems: list[str],
+    ):
+        index = 0
+        while index < len(tokens):
+            if index in table_positions or tokens[index].identifier is None or tokens[index].text.startswith("@"):
+                index += 1
+                continue
+            if index and tokens[index - 1].text == ".":
+                index += 1
+                continue
+            parts, end = self._read_name(tokens, index)
+            called = end < len(tokens) and tokens[end].text == "("
+            if len(parts) >= 2 and not called:
+                qualifier, column = ".".join(parts[:-1]), parts[-1]
+                if qualifier not in qualifiers:
+                    problems.append(f"Unknown table or alias {qualifier} in {'.'.join(parts)}")
+                else:
+                    columns = qualifiers[qualifier]
+                    if columns is not None and column != "*" and column not in columns:
+                        problems.append(
+                            f"Unknown column {column} in {qualifier}, its columns are: {', '.join(columns.values())}"
+                        )
+            index = max(end, index + 1)
@@ -1,4 +1,6 @@
 import multiprocessing
+import os
+import secrets
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -11,3 +13,7 @@ timeout = 230
 num_cpus = multiprocessing.cpu_count()
 workers = (num_cpus * 2) + 1
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# Workers inherit the environment, so a secret generated here lets any worker serve another worker's continuation
+# tokens. Set CONTINUATION_SECRET yourself when running more than one instance.
+os.environ.setdefault("CONTINUATION_SECRET", secrets.token_hex(32))
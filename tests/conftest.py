@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The backend modules import each other as top level packages (core, approaches), as they do when run from app/backend
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "backend"))
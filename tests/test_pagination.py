@@ -0,0 +1,108 @@
+import pytest
+
+from core.pagination import (
+    InvalidContinuationError,
+    decode_continuation,
+    encode_continuation,
+    fetch_page,
+    paged_sql,
+)
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.position = 0
+        self.cancelled = False
+
+    def fetchmany(self, size):
+        batch = self.rows[self.position : self.position + size]
+        self.position += len(batch)
+        return batch
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def test_paged_sql_appends_offset_fetch():
+    assert paged_sql("SELECT a FROM t ORDER BY a;", 20, 10) == (
+        "SELECT a FROM t ORDER BY a\nOFFSET 20 ROWS FETCH NEXT 11 ROWS ONLY"
+    )
+
+
+def test_paged_sql_goes_before_option():
+    assert paged_sql("SELECT a FROM t ORDER BY a OPTION (RECOMPILE)", 10, 10) == (
+        "SELECT a FROM t ORDER BY a\nOFFSET 10 ROWS FETCH NEXT 11 ROWS ONLY\nOPTION (RECOMPILE)"
+    )
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT a FROM t",
+        "SELECT TOP 5 a FROM t ORDER BY a",
+        "SELECT a FROM t ORDER BY a OFFSET 0 ROWS",
+        "SELECT a FROM t ORDER BY a FOR JSON PATH",
+        "SELECT a FROM t ORDER BY a; SELECT b FROM u ORDER BY b",
+        "SELECT a FROM (SELECT TOP 5 a FROM t ORDER BY a) AS s",
+        "SELECT a FROM t ORDER BY (a",
+    ],
+)
+def test_paged_sql_returns_none_when_not_pageable(sql):
+    assert paged_sql(sql, 10, 10) is None
+
+
+def test_paged_sql_ignores_keywords_in_literals_and_subqueries():
+    sql = "SELECT a, 'TOP' AS b FROM (SELECT TOP 5 a FROM t ORDER BY a) AS s ORDER BY a -- FOR"
+    assert paged_sql(sql, 5, 5).endswith("\nOFFSET 5 ROWS FETCH NEXT 6 ROWS ONLY")
+
+
+def test_fetch_page_server_paged_reads_from_the_start():
+    cursor = FakeCursor(range(5))
+    assert fetch_page(cursor, 10, 3, server_paged=True) == ([0, 1, 2], True)
+
+
+def test_fetch_page_skips_rows_before_the_page():
+    cursor = FakeCursor(range(25))
+    rows, has_more = fetch_page(cursor, 10, 10, server_paged=False)
+    assert rows == list(range(10, 20))
+    assert has_more
+    assert cursor.cancelled
+
+
+def test_fetch_page_last_page():
+    cursor = FakeCursor(range(12))
+    assert fetch_page(cursor, 10, 10, server_paged=False) == ([10, 11], False)
+
+
+def test_fetch_page_past_the_end():
+    cursor = FakeCursor(range(3))
+    assert fetch_page(cursor, 10, 10, server_paged=False) == ([], False)
+
+
+def test_continuation_round_trip():
+    continuation = {"sql": "SELECT a FROM t ORDER BY a", "offset": 10, "page_size": 10}
+    token = encode_continuation(continuation, b"key", ttl=60)
+    assert decode_continuation(token, b"key") == continuation
+
+
+@pytest.mark.parametrize("token", ["", "no-dot", "a.b.c", 42])
+def test_continuation_rejects_malformed_tokens(token):
+    with pytest.raises(InvalidContinuationError):
+        decode_continuation(token, b"key")
+
+
+def test_continuation_rejects_other_keys_and_tampering():
+    token = encode_continuation({"sql": "SELECT 1"}, b"key", ttl=60)
+    with pytest.raises(InvalidContinuationError):
+        decode_continuation(token, b"other key")
+    _, signature = token.split(".")
+    forged = encode_continuation({"sql": "SELECT 2"}, b"key", ttl=60).split(".")[0]
+    with pytest.raises(InvalidContinuationError):
+        decode_continuation(f"{forged}.{signature}", b"key")
+
+
+def test_continuation_expires():
+    token = encode_continuation({"sql": "SELECT 1"}, b"key", ttl=-1)
+    with pytest.raises(InvalidContinuationError):
+        decode_continuation(token, b"key")
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from core.schemacatalog import SchemaCatalog, SchemaUnavailableError
+
+
+class FlakyDatabase:
+    def __init__(self):
+        self.available = False
+        self.version_queries = 0
+
+    async def load_version(self):
+        self.version_queries += 1
+        if not self.available:
+            raise ConnectionError("The database is unreachable")
+        return "1"
+
+    async def load_tables(self, version):
+        return ["dbo.Orders (OrderID, Total)"]
+
+
+def test_failed_first_load_is_retried_once_per_interval():
+    async def scenario():
+        database = FlakyDatabase()
+        catalog = SchemaCatalog(database.load_tables, database.load_version, check_interval=0.2)
+        with pytest.raises(ConnectionError):
+            await catalog.get()
+        for _ in range(3):
+            with pytest.raises(SchemaUnavailableError):
+                await catalog.get()
+        assert database.version_queries == 1
+
+        database.available = True
+        await asyncio.sleep(0.25)
+        assert await catalog.get() == "dbo.Orders (OrderID, Total)\n"
+        assert database.version_queries == 2
+
+    asyncio.run(scenario())
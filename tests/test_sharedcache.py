@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from core.sharedcache import RedisSharedCache
+
+
+async def start_server(handle):
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def serve_dictionary(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, values: dict):
+    # Just enough RESP for GET and SET, the connection is closed after one command
+    count = int((await reader.readline())[1:])
+    args = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2].decode())
+    if args[0] == "SET":
+        values[args[1]] = args[2]
+        writer.write(b"+OK\r\n")
+    else:
+        value = values.get(args[1])
+        writer.write(b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value.encode()))
+    await writer.drain()
+    writer.close()
+
+
+def test_hung_server_is_skipped_after_the_first_timeout():
+    async def scenario():
+        async def never_reply(reader, writer):
+            await reader.read()
+
+        server, port = await start_server(never_reply)
+        cache = RedisSharedCache("127.0.0.1", port, timeout=0.2, down_for=30)
+        started = time.monotonic()
+        assert await asyncio.gather(*(cache.get(f"key{i}") for i in range(5))) == [None] * 5
+        assert time.monotonic() - started < 1
+        assert cache.is_down
+
+        started = time.monotonic()
+        for i in range(20):
+            assert await cache.get(f"key{i}") is None
+            await cache.set(f"key{i}", i, 60)
+        assert time.monotonic() - started < 0.1
+        await cache.close()
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_connection_closed_by_the_server_is_replaced():
+    async def scenario():
+        values: dict = {}
+        server, port = await start_server(lambda reader, writer: serve_dictionary(reader, writer, values))
+        cache = RedisSharedCache("127.0.0.1", port, timeout=1)
+        await cache.set("answer", {"rows": [1, 2]}, 60)
+        await asyncio.sleep(0.05)
+        assert await cache.get("answer") == {"rows": [1, 2]}
+        assert await cache.get("missing") is None
+        assert not cache.is_down
+        await cache.close()
+        server.close()
+
+    asyncio.run(scenario())
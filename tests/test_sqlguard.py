@@ -0,0 +1,45 @@
+from core.sqlguard import QueryGuard
+
+PERMISSION_DENIED = (
+    "('42000', \"[42000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]"
+    "SHOWPLAN permission denied in database 'sales'. (262) (SQLExecDirectW)\")"
+)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, statement):
+        self.connection.statements.append(statement)
+        if not statement.startswith("SET"):
+            raise Exception(self.connection.error)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, error):
+        self.error = error
+        self.statements = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+def test_check_stops_asking_for_plans_after_a_permission_error():
+    guard = QueryGuard(max_cost=100)
+    connection = FakeConnection(PERMISSION_DENIED)
+    assert guard.check(connection, "SELECT 1", 11)["action"] == "unchecked"
+    assert guard.plans_denied
+    statements = len(connection.statements)
+    assert guard.check(connection, "SELECT 1", 11)["action"] == "unchecked"
+    assert len(connection.statements) == statements
+
+
+def test_check_keeps_asking_for_plans_after_other_errors():
+    guard = QueryGuard(max_cost=100)
+    connection = FakeConnection("Invalid object name 'missing'. (208)")
+    assert guard.check(connection, "SELECT 1", 11)["action"] == "unchecked"
+    assert not guard.plans_denied
@@ -0,0 +1,98 @@
+import pytest
+
+from core.sqlvalidator import SqlValidationError, SqlValidator, tokenize_sql
+
+TABLES = [
+    "SalesLT.Customer (CustomerID, FirstName, LastName, CompanyName)",
+    "SalesLT.SalesOrderHeader (SalesOrderID, CustomerID, TotalDue, OrderDate)",
+]
+OBJECTS = [
+    "SalesLT.vGetAllCategories (ParentProductCategoryName, ProductCategoryName, ProductCategoryID)",
+    "SalesLT.Clients",
+]
+
+
+@pytest.fixture
+def validator():
+    return SqlValidator(TABLES, version="1", objects=OBJECTS)
+
+
+def problems(validator, sql):
+    with pytest.raises(SqlValidationError) as error:
+        validator.validate(sql)
+    return error.value
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT TOP 10 c.FirstName, SUM(h.TotalDue) AS total FROM SalesLT.Customer c "
+        "JOIN SalesLT.SalesOrderHeader AS h ON c.CustomerID = h.CustomerID GROUP BY c.FirstName ORDER BY total DESC;",
+        "SELECT * FROM Customer, SalesOrderHeader WHERE Customer.CustomerID = SalesOrderHeader.CustomerID",
+        "select [c].[FirstName] from [saleslt].[customer] as [c]",
+        "WITH t AS (SELECT CustomerID FROM SalesLT.Customer) SELECT t.CustomerID, d.a FROM t "
+        "JOIN (SELECT 1 AS a) d ON d.a = t.CustomerID",
+        "SELECT TRIM(' ' FROM c.FirstName) FROM SalesLT.Customer AS c",
+        "SELECT name FROM sys.tables t WHERE t.anything = 1",
+        "SELECT h.TotalDue FROM SalesLT.SalesOrderHeader h CROSS APPLY OPENJSON('[]') WITH (a int) AS j WHERE j.a > 1",
+        "SELECT 'DELETE FROM x' AS text, c.FirstName FROM SalesLT.Customer c -- UPDATE",
+        "SELECT * FROM SalesLT.vGetAllCategories v WHERE v.ProductCategoryID = 1",
+        "SELECT c.Anything FROM SalesLT.Clients c",
+        "SELECT x.y FROM OtherDb.dbo.Things x",
+        "-- comment\nSELECT 1 /* ok */",
+    ],
+)
+def test_valid_queries(validator, sql):
+    validator.validate(sql)
+
+
+def test_unknown_column_lists_the_columns(validator):
+    error = problems(validator, "SELECT c.Email FROM SalesLT.Customer c")
+    assert error.fixable
+    assert error.problems == ["Unknown column email in c, its columns are: CustomerID, FirstName, LastName, CompanyName"]
+
+
+def test_unknown_column_in_a_view(validator):
+    error = problems(validator, "SELECT v.Name FROM SalesLT.vGetAllCategories v")
+    assert error.problems[0].startswith("Unknown column name in v")
+
+
+def test_unknown_table_suggests_close_matches(validator):
+    error = problems(validator, "SELECT * FROM SalesLT.Customers")
+    assert error.fixable
+    assert error.problems[0].startswith("Unknown table saleslt.customers, did you mean SalesLT.Customer")
+
+
+def test_unknown_alias(validator):
+    error = problems(validator, "SELECT o.x FROM SalesLT.Customer c")
+    assert error.problems == ["Unknown table or alias o in o.x"]
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "DELETE FROM SalesLT.Customer",
+        "UPDATE SalesLT.Customer SET FirstName = 'x'",
+        "SELECT * INTO backup FROM SalesLT.Customer",
+        "WITH t AS (SELECT 1 AS a) DELETE FROM SalesLT.Customer",
+        "EXEC sp_who",
+        "DECLARE @x int",
+    ],
+)
+def test_writes_are_not_fixable(validator, sql):
+    assert not problems(validator, sql).fixable
+
+
+@pytest.mark.parametrize(
+    "sql",
+    ["SELECT (1", "SELECT 1)", "SELECT 'abc", "SELECT [abc", "SELECT 1 /* open", "SELECT 1; SELECT 2", ""],
+)
+def test_syntax_problems_are_fixable(validator, sql):
+    assert problems(validator, sql).fixable
+
+
+def test_tokenizer_keeps_literals_and_quoted_identifiers_whole():
+    tokens = tokenize_sql("SELECT N'it''s', [a]]b], \"c\" FROM t -- tail")
+    assert [token.kind for token in tokens] == ["word", "string", "symbol", "quoted", "symbol", "quoted", "word", "word"]
+    assert tokens[3].identifier == "a]b"
+    assert tokens[5].identifier == "c"